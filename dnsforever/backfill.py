@@ -0,0 +1,165 @@
+import socket
+import unittest
+from collections import OrderedDict
+
+from sqlalchemy import inspect
+
+from dnsforever.models import Base, Session, engine, Domain, Record, \
+    RecordA, RecordAAAA, RecordDDNS_A, RecordDDNS_AAAA, RecordMX, RecordTXT
+
+# Typed rdata columns, filled from rdata for rows written before they
+# existed. The first column of each model marks rows still to be filled.
+TYPED_COLUMNS = OrderedDict([
+    (RecordA, ('address',)),
+    (RecordAAAA, ('address',)),
+    (RecordDDNS_A, ('address',)),
+    (RecordDDNS_AAAA, ('address',)),
+    (RecordMX, ('preference', 'target')),
+    (RecordTXT, ('txt',)),
+])
+
+
+def add_columns(engine, table, names):
+    inspector = inspect(engine)
+    existing = set(column['name']
+                   for column in inspector.get_columns(table.name))
+    indexes = set(index['name']
+                  for index in inspector.get_indexes(table.name))
+
+    added = []
+    for name in names:
+        if name in existing:
+            continue
+        engine.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                       (table.name, name,
+                        table.c[name].type.compile(engine.dialect)))
+        added.append('%s.%s' % (table.name, name))
+
+    for index in table.indexes:
+        if index.name not in indexes and \
+                any(name in index.columns for name in names):
+            index.create(engine)
+    return added
+
+
+def add_typed_columns(engine):
+    tables = inspect(engine).get_table_names()
+
+    added = []
+    for model, columns in TYPED_COLUMNS.items():
+        if model.__table__.name in tables:
+            added.extend(add_columns(engine, model.__table__, columns))
+    return added
+
+
+def backfill_records(session, model, batch_size=1000):
+    column = getattr(model, TYPED_COLUMNS[model][0])
+
+    filled = failed = last_id = 0
+    while True:
+        with session.begin():
+            records = session.query(model)\
+                             .filter(column.is_(None))\
+                             .filter(model.id > last_id)\
+                             .order_by(model.id)\
+                             .limit(batch_size)\
+                             .all()
+            if not records:
+                break
+            last_id = records[-1].id
+
+            # Normalizing rdata can change a record's zone line, which
+            # needs a new serial like any other edit.
+            domains = set()
+            for record in records:
+                line = record.line
+                try:
+                    record.parse_rdata(record.rdata)
+                except (ValueError, socket.error):
+                    failed += 1
+                    continue
+                filled += 1
+                if record.line != line:
+                    domains.add(record.domain)
+
+            for domain in domains:
+                domain.update()
+        session.expunge_all()
+
+    return filled, failed
+
+
+def backfill_all(batch_size=1000):
+    session = Session()
+    return OrderedDict((model.__mapper__.polymorphic_identity,
+                        backfill_records(session, model, batch_size))
+                       for model in TYPED_COLUMNS)
+
+
+class BackfillTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+
+    def test_backfill_all(self):
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        with s.begin():
+            s.add(RecordA(domain=domain, name='www', ip='127.0.0.1'))
+            s.add(RecordAAAA(domain=domain, name='www', ip='::1'))
+            s.add(RecordMX(domain=domain, name=None, preference=10,
+                           target='mx.dnsforever.kr'))
+            s.add(RecordTXT(domain=domain, name=None, txt='v=spf1 -all'))
+        serial = domain.update_serial
+
+        # Rows as they were stored before the typed columns existed.
+        for model, columns in TYPED_COLUMNS.items():
+            engine.execute(model.__table__.update()
+                                .values(**dict((name, None)
+                                               for name in columns)))
+        engine.execute(Record.__table__.update()
+                             .where(Record.__table__.c.type == 'AAAA')
+                             .values(rdata='0:0::1'))
+        engine.execute(Record.__table__.update()
+                             .where(Record.__table__.c.type == 'TXT')
+                             .values(rdata='v=spf1 -all'))
+
+        self.assertEqual(backfill_all(batch_size=1),
+                         OrderedDict([('A', (1, 0)),
+                                      ('AAAA', (1, 0)),
+                                      ('ddns_a', (0, 0)),
+                                      ('ddns_aaaa', (0, 0)),
+                                      ('MX', (1, 0)),
+                                      ('TXT', (1, 0))]))
+
+        s.expire_all()
+        self.assertEqual(s.query(RecordA.address).scalar(),
+                         '\x7f\x00\x00\x01')
+        self.assertEqual(s.query(RecordAAAA.rdata).scalar(), '::1')
+        self.assertEqual(s.query(RecordMX.preference, RecordMX.target).one(),
+                         (10, 'mx.dnsforever.kr'))
+        self.assertEqual(s.query(RecordTXT.rdata).scalar(), '"v=spf1 -all"')
+        self.assertEqual(domain.update_serial, serial + 2)
+
+    def test_backfill_quoted_txt(self):
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        with s.begin():
+            s.add(RecordTXT(domain=domain, name=None, txt='v=spf1 -all'))
+            s.add(RecordTXT(domain=domain, name='q', txt='a"b'))
+        serial = domain.update_serial
+
+        # Quoted by the user, as the old export took rdata verbatim.
+        engine.execute(RecordTXT.__table__.update().values(txt=None))
+        engine.execute(Record.__table__.update()
+                             .where(Record.__table__.c.name.is_(None))
+                             .values(rdata='"v=spf1 -all"'))
+
+        self.assertEqual(backfill_records(Session(), RecordTXT), (2, 0))
+        s.expire_all()
+        self.assertEqual(sorted(s.query(RecordTXT.txt, RecordTXT.rdata)),
+                         [('a"b', '"a\\"b"'),
+                          ('v=spf1 -all', '"v=spf1 -all"')])
+        self.assertEqual(domain.update_serial, serial)
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
@@ -1,12 +1,97 @@
 database_url = 'sqlite:///database.db'
+# Read-only traffic (zone export, dashboard) goes here when set.
+database_replica_url = None
+
+# Pool settings for server databases; SQLite keeps its default pool.
+database_pool_size = 5
+database_max_overflow = 10
+database_pool_recycle = 300
+# Test every server database connection with SELECT 1 when it leaves the
+# pool; SQLite connections are never pinged.
+database_pool_pre_ping = True
+# Applied to every new SQLite connection.
+sqlite_pragmas = {'journal_mode': 'WAL',
+                  'synchronous': 'NORMAL',
+                  'busy_timeout': 5000}
+
+# 'joined' keeps a table per record type; 'single' stores every record
+# type in the record table so that a zone loads with one indexed scan.
+# Run `manage.py migrate_records` after changing it.
+record_layout = 'joined'
 
 secret_key = 'SECRET_KEY'
 hash_salt = 'HASH_SALT'
 
 webforwarding_domain = 'webforwarding.dnsforever.kr'
 
+# Token and ticket lifetimes in seconds.
+email_validation_lifetime = 7 * 24 * 3600
+findpasswd_lifetime = 3600
+subdomain_sharing_lifetime = 30 * 24 * 3600
+api_token_lifetime = 365 * 24 * 3600
+# Seconds of record change journal kept for /apis/server/changes and IXFR;
+# nameservers further behind get a full transfer.
+record_change_lifetime = 30 * 24 * 3600
+# Seconds between in-process sweeps of expired tokens; 0 leaves it to
+# `manage.py sweep`.
+token_sweep_interval = 3600
+token_sweep_batch_size = 1000
+
+# Rows per page in record, domain and ticket listings; API clients may ask
+# for up to max_page_size.
+page_size = 100
+max_page_size = 1000
+
+# Base URL for links in emails rendered outside a request.
+service_url = 'https://dnsforever.kr'
+
 smtp_ssl = False
 smtp_host = 'localhost'
 smtp_port = 25
 smtp_account = None
 # smtp_account = ('username', 'password')
+smtp_from = 'noreply@dnsforever.kr'
+smtp_pool_size = 2
+
+# Start the outbox sender inside the web process; set to False when
+# `manage.py mailer` runs it separately.
+mail_sender_enabled = True
+# Seconds between outbox polls for retries.
+mail_poll_interval = 10
+mail_max_attempts = 8
+# First retry delay in seconds, doubled after every failed attempt.
+mail_retry_delay = 60
+# Seconds to keep sent email in the outbox before the sweeper purges it.
+mail_sent_lifetime = 7 * 24 * 3600
+# Cache compiled email templates in Jinja's private per-user directory;
+# False keeps them in memory only.
+email_template_bytecode_cache = False
+
+# 'memory', 'file' or None
+zone_cache_backend = 'memory'
+zone_cache_size = 10000
+# Required by the 'file' backend: a directory owned by this user and not
+# writable by group or others. It is created with mode 0700 if missing.
+zone_cache_path = None
+
+notify_enabled = True
+notify_port = 53
+# Longest a /apis/server/wait poll holds a web worker, in seconds; clients
+# poll again when it returns unchanged.
+server_wait_timeout = 5
+
+# Seconds to coalesce DDNS address changes before writing them; 0 writes
+# every change immediately.
+ddns_flush_interval = 5
+# Failed flushes keep their updates for this many attempts.
+ddns_flush_retries = 3
+
+# Add X-DB-Statements, X-DB-Time, X-Render-Time and X-Response-Time
+# headers to every response.
+metrics_headers = False
+
+password_hash_iterations = 10000
+
+# Path to a publicsuffix.org format file; None uses dnsforever.domain's
+# built-in ROOT_DOMAIN list.
+public_suffix_list = None
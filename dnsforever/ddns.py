@@ -0,0 +1,161 @@
+import atexit
+import logging
+import time
+import unittest
+from threading import Lock, Thread
+
+from sqlalchemy.orm import joinedload
+
+from dnsforever.config import ddns_flush_interval, ddns_flush_retries
+from dnsforever.models import Base, Session, engine, Domain, Record, \
+    RecordDDNS_A, RecordDDNS_AAAA
+
+logger = logging.getLogger(__name__)
+
+
+def find_ddns_records(session, key):
+    queries = [session.query(cls.id, cls.name, cls.type, cls.rdata,
+                             Domain.name)
+                      .join(Domain, cls.domain_id == Domain.id)
+                      .filter(cls.ddns_key == key)
+               for cls in (RecordDDNS_A, RecordDDNS_AAAA)]
+    return queries[0].union_all(queries[1]).all()
+
+
+def apply_ddns_updates(session, updates):
+    if not updates:
+        return 0
+
+    records = session.query(Record)\
+                     .options(joinedload(Record.domain))\
+                     .filter(Record.id.in_(updates.keys()))\
+                     .all()
+
+    changed = 0
+    with session.begin():
+        domains = set()
+        for record in records:
+            if record.rdata == updates[record.id]:
+                continue
+            record.ip = updates[record.id]
+            domains.add(record.domain)
+            changed += 1
+
+        for domain in domains:
+            domain.update()
+
+    return changed
+
+
+class DdnsBuffer(object):
+    def __init__(self, interval=ddns_flush_interval,
+                 retries=ddns_flush_retries):
+        self.interval = interval
+        self.retries = retries
+        self.failures = 0
+        self.pending = {}
+        self.lock = Lock()
+        self.thread = None
+
+    def get(self, record_id):
+        with self.lock:
+            return self.pending.get(record_id)
+
+    def put(self, updates):
+        with self.lock:
+            self.pending.update(updates)
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        with self.lock:
+            updates, self.pending = self.pending, {}
+        try:
+            changed = apply_ddns_updates(Session(), updates)
+        except Exception:
+            with self.lock:
+                self.failures += 1
+                if self.failures < self.retries:
+                    # Updates that arrived meanwhile are newer and win.
+                    updates.update(self.pending)
+                    self.pending = updates
+                    logger.exception('DDNS flush failed, %d updates kept',
+                                     len(updates))
+                else:
+                    self.failures = 0
+                    logger.exception('DDNS flush failed %d times, '
+                                     '%d updates dropped',
+                                     self.retries, len(updates))
+            raise
+        self.failures = 0
+        return changed
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                # flush() has logged it and kept the batch for a retry.
+                continue
+
+
+class DdnsBufferTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        record = RecordDDNS_A(domain=domain, name='home', ip='127.0.0.1',
+                              memo=u'')
+        record6 = RecordDDNS_AAAA(domain=domain, name='home', ip='::1',
+                                  memo=u'', ddns_key=record.ddns_key)
+
+        with s.begin():
+            s.add(record)
+            s.add(record6)
+
+        self.record_id = record.id
+        self.record6_id = record6.id
+        self.ddns_key = record.ddns_key
+
+    def test_find_ddns_records(self):
+        records = find_ddns_records(Session(), self.ddns_key)
+        self.assertEqual(sorted((type, rdata) for _, _, type, rdata, _
+                                in records),
+                         [('A', '127.0.0.1'), ('AAAA', '::1')])
+
+    def test_flush(self):
+        buf = DdnsBuffer(interval=3600)
+        buf.pending[self.record_id] = '127.0.0.2'
+        buf.pending[self.record6_id] = '::2'
+        self.assertEqual(buf.flush(), 2)
+        self.assertEqual(buf.pending, {})
+
+        buf.pending[self.record_id] = '127.0.0.2'
+        self.assertEqual(buf.flush(), 0)
+
+        s = Session()
+        record = s.query(RecordDDNS_A).get(self.record_id)
+        self.assertEqual(record.ip, '127.0.0.2')
+        self.assertEqual(record.domain.update_serial, 2)
+
+    def test_flush_failure(self):
+        buf = DdnsBuffer(interval=3600, retries=2)
+        buf.pending[self.record_id] = 'not an address'
+        self.assertRaises(Exception, buf.flush)
+        self.assertEqual(buf.pending, {self.record_id: 'not an address'})
+
+        buf.pending[self.record_id] = '127.0.0.3'
+        buf.pending[self.record6_id] = 'not an address'
+        self.assertRaises(Exception, buf.flush)
+        self.assertEqual(buf.pending, {})
+
+        buf.pending[self.record_id] = '127.0.0.3'
+        self.assertEqual(buf.flush(), 1)
+        self.assertEqual(buf.failures, 0)
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
@@ -1,3 +1,8 @@
+import unittest
+from StringIO import StringIO
+
+from dnsforever.config import public_suffix_list
+
 ROOT_DOMAIN = ['ac', 'academy', 'accountants', 'actor', 'ad', 'ae', 'aero',
                'af', 'ag', 'agency', 'ai', 'airforce', 'al', 'am', 'an', 'ao',
                'aq', 'ar', 'archi', 'arpa', 'as', 'asia', 'associates', 'at',
@@ -72,10 +77,139 @@ ROOT_DOMAIN = ['ac', 'academy', 'accountants', 'actor', 'ad', 'ae', 'aero',
                'viajes', 'villas', 'vision', 'vn', 'vodka', 'vote', 'voting',
                'voto', 'voyage', 'vu',
                'wang', 'watch', 'webcam', 'wed', 'wf', 'wien', 'wiki', 'works',
-               'ws', 'wtc', 'wtf'
+               'ws', 'wtc', 'wtf',
                'co.kr', 'ne.kr', 'or.kr', 're.kr', 'pe.kr', 'go.kr', 'mil.kr',
                'ac.kr', 'hs.kr', 'ms.kr', 'es.kr', 'sc.kr', 'kg.kr',
                'seoul.kr', 'busan.kr', 'daegu.kr', 'incheon.kr', 'gwangju.kr',
                'daejeon.kr', 'ulsan.kr', 'gyeonggi.kr', 'gangwon.kr',
                'chungbuk.kr', 'chungnam.kr', 'jeonbuk.kr', 'jeonnam.kr',
                'gyeongbuk.kr', 'gyeongnam.kr', 'jeju.kr']
+
+
+RULE = 1
+EXCEPTION_RULE = 2
+
+
+class PublicSuffixList(object):
+    def __init__(self, rules=()):
+        self.root = {}
+        for rule in rules:
+            self.add(rule)
+
+    @classmethod
+    def load(cls, fileobj):
+        psl = cls()
+        for line in fileobj:
+            line = line.strip()
+            if not line or line.startswith('//'):
+                continue
+            psl.add(line.split()[0].decode('utf-8').encode('idna'))
+        return psl
+
+    def add(self, rule):
+        kind = RULE
+        if rule.startswith('!'):
+            kind = EXCEPTION_RULE
+            rule = rule[1:]
+
+        node = self.root
+        for label in reversed(rule.lower().split('.')):
+            node = node.setdefault(label, {})
+        node[None] = kind
+
+    def public_suffix(self, domain):
+        labels = domain.lower().rstrip('.').split('.')
+        labels.reverse()
+
+        match = 1
+        nodes = [self.root]
+        for depth, label in enumerate(labels, 1):
+            children = []
+            for node in nodes:
+                for key in (label, '*'):
+                    child = node.get(key)
+                    if child is None:
+                        continue
+                    kind = child.get(None)
+                    if kind == EXCEPTION_RULE:
+                        return '.'.join(reversed(labels[:depth - 1]))
+                    if kind == RULE:
+                        match = max(match, depth)
+                    children.append(child)
+            if not children:
+                break
+            nodes = children
+
+        return '.'.join(reversed(labels[:match]))
+
+    def registrable_domain(self, domain):
+        suffix = self.public_suffix(domain)
+        labels = domain.lower().rstrip('.').split('.')
+        suffix_length = suffix.count('.') + 1
+        if len(labels) <= suffix_length:
+            return None
+        return '.'.join(labels[-suffix_length - 1:])
+
+    def __contains__(self, domain):
+        return self.public_suffix(domain) == domain.lower().rstrip('.')
+
+
+def load_public_suffixes(path=public_suffix_list):
+    if path is None:
+        return PublicSuffixList(ROOT_DOMAIN)
+    with open(path) as f:
+        return PublicSuffixList.load(f)
+
+
+PUBLIC_SUFFIXES = load_public_suffixes()
+
+
+def domain_suffixes(domain, registrable_domain=None):
+    labels = domain.split('.')
+    if registrable_domain is not None:
+        labels_count = len(labels) - registrable_domain.count('.')
+    else:
+        labels_count = len(labels)
+    return ['.'.join(labels[i:]) for i in xrange(labels_count)]
+
+
+class PublicSuffixListTestCase(unittest.TestCase):
+    def setUp(self):
+        self.psl = PublicSuffixList.load(StringIO(
+            '// comment\n'
+            'kr\n'
+            'co.kr\n'
+            '\n'
+            '*.ck\n'
+            '!www.ck\n'))
+
+    def test_public_suffix(self):
+        self.assertEqual(self.psl.public_suffix('dnsforever.kr'), 'kr')
+        self.assertEqual(self.psl.public_suffix('www.dnsforever.co.kr'),
+                         'co.kr')
+        self.assertEqual(self.psl.public_suffix('dnsforever.com'), 'com')
+        self.assertEqual(self.psl.public_suffix('a.b.ck'), 'b.ck')
+        self.assertEqual(self.psl.public_suffix('www.ck'), 'ck')
+
+    def test_registrable_domain(self):
+        self.assertEqual(self.psl.registrable_domain('www.dnsforever.co.kr'),
+                         'dnsforever.co.kr')
+        self.assertEqual(self.psl.registrable_domain('www.ck'), 'www.ck')
+        self.assertIsNone(self.psl.registrable_domain('co.kr'))
+        self.assertIsNone(self.psl.registrable_domain('b.ck'))
+
+    def test_contains(self):
+        self.assertIn('co.kr', self.psl)
+        self.assertNotIn('dnsforever.kr', self.psl)
+        self.assertNotIn('ne.kr', self.psl)
+
+    def test_root_domain(self):
+        self.assertIn('wtf', PUBLIC_SUFFIXES)
+        self.assertIn('co.kr', PUBLIC_SUFFIXES)
+
+    def test_domain_suffixes(self):
+        self.assertEqual(domain_suffixes('www.dnsforever.kr'),
+                         ['www.dnsforever.kr', 'dnsforever.kr', 'kr'])
+        self.assertEqual(domain_suffixes('www.dnsforever.co.kr',
+                                         'dnsforever.co.kr'),
+                         ['www.dnsforever.co.kr', 'dnsforever.co.kr'])
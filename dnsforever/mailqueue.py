@@ -0,0 +1,348 @@
+import time
+import socket
+import logging
+import smtpd
+import smtplib
+import asyncore
+import unittest
+from datetime import datetime, timedelta
+from email.header import Header
+from email.mime.text import MIMEText
+from multiprocessing.pool import ThreadPool
+from threading import Event, Lock, Thread
+
+from sqlalchemy import select, and_
+
+from dnsforever.config import smtp_ssl, smtp_host, smtp_port, smtp_account, \
+    smtp_from, smtp_pool_size, mail_poll_interval, mail_max_attempts, \
+    mail_retry_delay
+from dnsforever.models import Base, Session, engine, OutboxEmail
+
+SMTP_TIMEOUT = 30
+# Pooled connections idle for longer than this are dropped rather than
+# probed; most relays hang up on idle clients after a minute or so.
+SMTP_IDLE_TIMEOUT = 60
+# A claimed message is retried by another sender if it is still unsent
+# after this many seconds.
+CLAIM_TIMEOUT = 300
+
+logger = logging.getLogger(__name__)
+
+
+def build_message(to, subject, body, sender=smtp_from):
+    msg = MIMEText(body.encode('utf-8'), 'plain', 'utf-8')
+    msg['Subject'] = Header(subject, 'utf-8')
+    msg['From'] = sender
+    msg['To'] = to
+    return msg.as_string()
+
+
+def enqueue_email(session, to, subject, body):
+    session.add(OutboxEmail(to=to, subject=subject, body=body,
+                            next_attempt_at=datetime.utcnow()))
+
+
+def enqueue_emails(session, subject, messages, chunk_size=1000):
+    insert = OutboxEmail.__table__.insert()
+    now = datetime.utcnow()
+    count = 0
+    with session.begin():
+        chunk = []
+        for to, body in messages:
+            chunk.append({'to': to, 'subject': subject, 'body': body,
+                          'next_attempt_at': now})
+            if len(chunk) >= chunk_size:
+                session.execute(insert, chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            session.execute(insert, chunk)
+            count += len(chunk)
+    return count
+
+
+def retry_delay(attempts, delay=mail_retry_delay):
+    return timedelta(seconds=delay * 2 ** (attempts - 1))
+
+
+class SMTPPool(object):
+    def __init__(self, size=smtp_pool_size, host=smtp_host, port=smtp_port,
+                 ssl=smtp_ssl, account=smtp_account):
+        self.size = size
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.account = account
+        self.idle = []
+        self.lock = Lock()
+
+    def connect(self):
+        if self.ssl:
+            conn = smtplib.SMTP_SSL(self.host, self.port, timeout=SMTP_TIMEOUT)
+        else:
+            conn = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        if self.account:
+            conn.login(*self.account)
+        return conn
+
+    def get(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn, last_used = self.idle.pop()
+
+            if time.time() - last_used < SMTP_IDLE_TIMEOUT:
+                try:
+                    if conn.noop()[0] == 250:
+                        return conn
+                except (smtplib.SMTPException, socket.error):
+                    pass
+            self.discard(conn)
+
+        return self.connect()
+
+    def put(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((conn, time.time()))
+                return
+        self.discard(conn)
+
+    def discard(self, conn):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, socket.error):
+            conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            self.discard(conn)
+
+    def send(self, sender, to, message):
+        conn = self.get()
+        try:
+            conn.sendmail(sender, [to], message)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+            # The server rejected this message but the session is intact.
+            self.put(conn)
+            raise
+        except:
+            conn.close()
+            raise
+        self.put(conn)
+
+
+class MailSender(object):
+    def __init__(self, pool=None, interval=mail_poll_interval,
+                 batch_size=100, max_attempts=mail_max_attempts,
+                 retry_delay=mail_retry_delay):
+        self.pool = pool or SMTPPool()
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.workers = None
+        self.wakeup = Event()
+        self.lock = Lock()
+        self.thread = None
+
+    def wake(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+        self.wakeup.set()
+
+    def claim(self, connection, rows):
+        outbox = OutboxEmail.__table__
+        lease = datetime.utcnow() + timedelta(seconds=CLAIM_TIMEOUT)
+
+        claimed = []
+        for row in rows:
+            result = connection.execute(
+                outbox.update()
+                      .where(and_(outbox.c.id == row.id,
+                                  outbox.c.attempts == row.attempts))
+                      .values(attempts=row.attempts + 1,
+                              next_attempt_at=lease))
+            if result.rowcount == 1:
+                claimed.append(row)
+        return claimed
+
+    def deliver(self, row):
+        # Any failure is one failed attempt for this message only; the rest
+        # of the batch is still sent and recorded.
+        try:
+            self.pool.send(smtp_from, row.to,
+                           build_message(row.to, row.subject, row.body))
+        except Exception as e:
+            if not isinstance(e, (smtplib.SMTPException, socket.error)):
+                logger.exception('Sending email %d failed', row.id)
+            try:
+                error = unicode(e)
+            except UnicodeError:
+                error = u''
+            return (error or e.__class__.__name__)[:255]
+        return None
+
+    def send_pending(self):
+        outbox = OutboxEmail.__table__
+        connection = engine.connect()
+        try:
+            rows = connection.execute(
+                select([outbox])
+                .where(outbox.c.next_attempt_at <= datetime.utcnow())
+                .order_by(outbox.c.next_attempt_at)
+                .limit(self.batch_size)).fetchall()
+            rows = self.claim(connection, rows)
+            if not rows:
+                return 0
+
+            if self.workers is None:
+                self.workers = ThreadPool(self.pool.size)
+            errors = self.workers.map(self.deliver, rows)
+
+            sent = 0
+            with connection.begin():
+                for row, error in zip(rows, errors):
+                    attempts = row.attempts + 1
+                    if error is None:
+                        values = {'sent_at': datetime.utcnow(),
+                                  'next_attempt_at': None,
+                                  'last_error': None}
+                        sent += 1
+                    elif attempts >= self.max_attempts:
+                        values = {'next_attempt_at': None,
+                                  'last_error': error}
+                    else:
+                        values = {'next_attempt_at': datetime.utcnow() +
+                                  retry_delay(attempts, self.retry_delay),
+                                  'last_error': error}
+                    connection.execute(outbox.update()
+                                             .where(outbox.c.id == row.id)
+                                             .values(**values))
+            return sent
+        finally:
+            connection.close()
+
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                while self.send_pending():
+                    pass
+            except Exception:
+                logger.exception('Sending queued email failed')
+            self.wakeup.wait(self.interval)
+
+
+class SMTPStandIn(smtpd.SMTPServer):
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        self.thread = Thread(target=asyncore.loop, kwargs={'timeout': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def stop(self):
+        asyncore.close_all()
+        self.thread.join()
+
+
+class MailSenderTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        self.server = SMTPStandIn()
+
+    def test_send_pending(self):
+        s = Session()
+        with s.begin():
+            for i in xrange(3):
+                enqueue_email(s, u'user%d@dnsforever.kr' % i,
+                              u'DNS Forever', u'body %d' % i)
+
+        pool = SMTPPool(size=2, host='127.0.0.1', port=self.server.port,
+                        ssl=False, account=None)
+        sender = MailSender(pool)
+        self.assertEqual(sender.send_pending(), 3)
+        self.assertEqual(sender.send_pending(), 0)
+        pool.close()
+
+        self.assertEqual(sorted(rcpttos for _, rcpttos, _
+                                in self.server.messages),
+                         [['user0@dnsforever.kr'], ['user1@dnsforever.kr'],
+                          ['user2@dnsforever.kr']])
+        self.assertEqual(s.query(OutboxEmail)
+                          .filter(OutboxEmail.sent_at.is_(None)).count(), 0)
+
+    def test_send_pending_bad_address(self):
+        s = Session()
+        with s.begin():
+            enqueue_email(s, u'\xfc@dnsforever.kr', u'DNS Forever', u'body')
+            enqueue_email(s, u'user@dnsforever.kr', u'DNS Forever', u'body')
+
+        pool = SMTPPool(size=1, host='127.0.0.1', port=self.server.port,
+                        ssl=False, account=None)
+        sender = MailSender(pool, max_attempts=1)
+        self.assertEqual(sender.send_pending(), 1)
+        self.assertEqual(sender.send_pending(), 0)
+        pool.close()
+
+        bad, good = s.query(OutboxEmail).order_by(OutboxEmail.id)
+        self.assertEqual((bad.attempts, bad.next_attempt_at, bad.sent_at),
+                         (1, None, None))
+        self.assertIsNotNone(bad.last_error)
+        self.assertIsNotNone(good.sent_at)
+
+    def test_enqueue_emails(self):
+        s = Session()
+        count = enqueue_emails(s, u'DNS Forever',
+                               ((u'user%d@dnsforever.kr' % i, u'body')
+                                for i in xrange(5)), chunk_size=2)
+        self.assertEqual(count, 5)
+        self.assertEqual(s.query(OutboxEmail)
+                          .filter(OutboxEmail.next_attempt_at.isnot(None))
+                          .count(), 5)
+
+    def test_retry(self):
+        s = Session()
+        with s.begin():
+            enqueue_email(s, u'user@dnsforever.kr', u'DNS Forever', u'body')
+
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        sender = MailSender(SMTPPool(size=1, host='127.0.0.1', port=port,
+                                     ssl=False, account=None),
+                            max_attempts=2, retry_delay=60)
+        self.assertEqual(sender.send_pending(), 0)
+
+        email = s.query(OutboxEmail).one()
+        self.assertEqual(email.attempts, 1)
+        self.assertIsNotNone(email.last_error)
+        self.assertTrue(email.next_attempt_at >
+                        datetime.utcnow() + timedelta(seconds=30))
+
+        with s.begin():
+            email.next_attempt_at = datetime.utcnow()
+        self.assertEqual(sender.send_pending(), 0)
+
+        s.expire_all()
+        email = s.query(OutboxEmail).one()
+        self.assertEqual(email.attempts, 2)
+        self.assertIsNone(email.next_attempt_at)
+        self.assertIsNone(email.sent_at)
+
+    def tearDown(self):
+        self.server.stop()
+        Base.metadata.drop_all(engine)
@@ -1,17 +1,31 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine.url import make_url
 from sqlalchemy import Column, Integer, String, Unicode, Boolean, DateTime, \
-    UnicodeText
-from sqlalchemy import ForeignKey
-from sqlalchemy.orm import sessionmaker, validates, relationship
+    UnicodeText, LargeBinary
+from sqlalchemy import ForeignKey, Index
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker, validates, relationship, \
+    column_property, Session as BaseSession
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.sql import functions
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
+from datetime import datetime, timedelta
+import os
 import re
+import socket
+import hashlib
+import tempfile
 import unittest
 import string
 import random
 
-from dnsforever.config import database_url, webforwarding_domain
+from dnsforever.config import database_url, database_replica_url, \
+    database_pool_size, database_max_overflow, database_pool_recycle, \
+    database_pool_pre_ping, sqlite_pragmas, webforwarding_domain, \
+    email_validation_lifetime, findpasswd_lifetime, \
+    subdomain_sharing_lifetime, api_token_lifetime, record_layout
 
+TXT_ESCAPE_PATTERN = re.compile(r'\\(.)')
 
 Base = declarative_base()
 
@@ -20,6 +34,10 @@ def random_string(size=40, chars=string.ascii_lowercase + string.digits):
     return ''.join(random.choice(chars) for _ in xrange(size))
 
 
+def hash_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
 def check_domain(domain):
     if len(domain) > 255:
         raise ValueError('Domain name is too long.')
@@ -29,6 +47,24 @@ def check_domain(domain):
     return True
 
 
+def record_line(name, type, rdata):
+    return '%s %s %s' % (name or '@', type, rdata)
+
+
+def quote_txt(txt):
+    # Split before escaping so that no string ends inside an escape.
+    chunks = [txt[i:i + 255] for i in xrange(0, len(txt), 255)] or ['']
+    return ' '.join('"%s"' % chunk.replace('\\', '\\\\').replace('"', '\\"')
+                    for chunk in chunks)
+
+
+def unquote_txt(rdata):
+    # TXT rdata used to be stored as entered, often already quoted.
+    if len(rdata) >= 2 and rdata[0] == rdata[-1] == '"':
+        return TXT_ESCAPE_PATTERN.sub(r'\1', rdata[1:-1])
+    return rdata
+
+
 class User(Base):
     __tablename__ = 'user'
 
@@ -55,12 +91,31 @@ class User(Base):
         raise ValueError
 
 
-class EmailValidation(Base):
+class TokenMixin(object):
+    # Only the hash is stored; the plain token lives on the instance that
+    # created it, long enough to be mailed out.
+    token_hash = Column(String(64), nullable=False, unique=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def set_token(self, lifetime):
+        self.token = random_string()
+        self.token_hash = hash_token(self.token)
+        self.expires_at = datetime.utcnow() + timedelta(seconds=lifetime)
+
+    @classmethod
+    def find_token(cls, session, token):
+        return session.query(cls)\
+                      .filter(cls.token_hash == hash_token(token))\
+                      .filter(cls.expires_at > datetime.utcnow())\
+                      .first()
+
+
+class EmailValidation(TokenMixin, Base):
     __tablename__ = 'email_validation'
 
     def __init__(self, user):
         self.user = user
-        self.token = random_string()
+        self.set_token(email_validation_lifetime)
 
     id = Column(Integer, primary_key=True)
 
@@ -70,25 +125,59 @@ class EmailValidation(Base):
     created_at = Column(DateTime(timezone=True), nullable=False,
                         default=functions.now())
 
-    token = Column(Unicode(127), nullable=False)
-
 
-class FindPasswd(Base):
+class FindPasswd(TokenMixin, Base):
     __tablename__ = 'findpasswd'
 
     def __init__(self, user):
         self.user = user
-        self.token = random_string()
+        self.set_token(findpasswd_lifetime)
+
+    id = Column(Integer, primary_key=True)
+
+    user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    user = relationship(User)
+
+    created_at = Column(DateTime(timezone=True), nullable=False,
+                        default=functions.now())
+
+
+class ApiToken(TokenMixin, Base):
+    __tablename__ = 'api_token'
+
+    def __init__(self, user, name):
+        self.user = user
+        self.name = name
+        self.set_token(api_token_lifetime)
 
     id = Column(Integer, primary_key=True)
 
     user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
     user = relationship(User)
 
+    name = Column(Unicode(100), nullable=False)
+
+    created_at = Column(DateTime(timezone=True), nullable=False,
+                        default=functions.now())
+
+
+class OutboxEmail(Base):
+    __tablename__ = 'outbox_email'
+
+    id = Column(Integer, primary_key=True)
+
+    to = Column(Unicode(100), nullable=False)
+    subject = Column(Unicode(255), nullable=False)
+    body = Column(UnicodeText, nullable=False)
+
     created_at = Column(DateTime(timezone=True), nullable=False,
                         default=functions.now())
 
-    token = Column(Unicode(127), nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    # None once the message is sent or has used up its attempts.
+    next_attempt_at = Column(DateTime, nullable=True, index=True)
+    sent_at = Column(DateTime, nullable=True, index=True)
+    last_error = Column(Unicode(255), nullable=True)
 
 
 class Domain(Base):
@@ -108,6 +197,8 @@ class Domain(Base):
                        default=None)
     parent = relationship('Domain')
 
+    __table_args__ = (Index('ix_domain_parent_id_name', 'parent_id', 'name'),)
+
     @validates('domain')
     def domain_validates(self, key, domain):
         if not isinstance(domain, str):
@@ -130,7 +221,8 @@ class SubdomainSharing(Base):
         self.domain = domain
         self.name = name
         self.email = email
-        self.token = random_string()
+        self.expires_at = datetime.utcnow() + \
+            timedelta(seconds=subdomain_sharing_lifetime)
 
     id = Column(Integer, primary_key=True)
 
@@ -140,10 +232,18 @@ class SubdomainSharing(Base):
 
     email = Column(Unicode(100), nullable=False, index=True, unique=True)
 
+    __table_args__ = (Index('ix_subdomain_sharing_domain_id_name',
+                            'domain_id', 'name'),)
+
     created_at = Column(DateTime(timezone=True), nullable=False,
                         default=functions.now())
+    expires_at = Column(DateTime, nullable=False, index=True)
 
-    token = Column(Unicode(127), nullable=False)
+    @classmethod
+    def for_email(cls, session, email):
+        return session.query(cls)\
+                      .filter(cls.email == email)\
+                      .filter(cls.expires_at > datetime.utcnow())
 
 
 class DomainOwnership(Base):
@@ -151,7 +251,8 @@ class DomainOwnership(Base):
 
     id = Column(Integer, primary_key=True)
 
-    user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('user.id'), nullable=False,
+                     index=True)
     user = relationship(User, backref='ownership')
 
     domain_id = Column(Integer, ForeignKey('domain.id'), nullable=False)
@@ -169,6 +270,23 @@ class NameServer(Base):
     ip = Column(String(64), nullable=False)
 
 
+class RecordChange(Base):
+    __tablename__ = 'record_change'
+
+    id = Column(Integer, primary_key=True)
+
+    domain_id = Column(Integer, nullable=True, index=True)
+    domain_name = Column(String(255), nullable=False)
+    serial = Column(Integer, nullable=False)
+
+    action = Column(String(16), nullable=False)
+    old = Column(String(512), nullable=True)
+    new = Column(String(512), nullable=True)
+
+    created_at = Column(DateTime(timezone=True), nullable=False,
+                        default=functions.now(), index=True)
+
+
 class Record(Base):
     __tablename__ = 'record'
 
@@ -178,23 +296,95 @@ class Record(Base):
     domain_id = Column(Integer, ForeignKey('domain.id'), nullable=False)
     domain = relationship(Domain, backref='records')
 
-    name = Column(String(255), nullable=True)
-    type = Column(String(32), nullable=False)
+    name = column_property(Column(String(255), nullable=True),
+                           active_history=True)
+    type = column_property(Column(String(32), nullable=False),
+                           active_history=True)
     cls = Column(Integer, nullable=False)
-    ttl = Column(Integer, nullable=False)
-    rdata = Column(String(255), nullable=False)
+    ttl = column_property(Column(Integer, nullable=False),
+                          active_history=True)
+    rdata = column_property(Column(String(512), nullable=False),
+                            active_history=True)
 
     __mapper_args__ = {
         'polymorphic_identity': None,
         'polymorphic_on': service,
+        # Every type's columns are in the record table, so load them with
+        # the row rather than one query per record.
+        'with_polymorphic': '*' if record_layout == 'single' else None,
     }
 
+    # Record listings seek over (name, id) within a domain.
+    __table_args__ = (Index('ix_record_domain_id_name', 'domain_id', 'name'),)
+
     def update(self):
         self.domain.update()
 
+    @property
+    def line(self):
+        return record_line(self.name, self.type, self.rdata)
+
+    @property
+    def committed_line(self):
+        values = []
+        for key in ('name', 'type', 'rdata'):
+            history = get_history(self, key)
+            if history.deleted:
+                values.append(history.deleted[0])
+            else:
+                values.append(getattr(self, key))
+        return record_line(*values)
+
+
+def record_table(name):
+    # In the single-table layout every record type lives in `record`.
+    if record_layout == 'single':
+        return None
+    return name
+
+
+def record_id():
+    @declared_attr
+    def id(cls):
+        if record_layout == 'single':
+            return column_property(Record.__table__.c.id)
+        return Column(Integer, ForeignKey('record.id'), primary_key=True)
+    return id
+
+
+def record_column(name, *args, **kwargs):
+    @declared_attr
+    def column(cls):
+        if record_layout == 'single':
+            # Record types share one column per name, and a column only
+            # some rows use cannot be NOT NULL.
+            kwargs['nullable'] = True
+            return Record.__table__.c.get(name, Column(name, *args, **kwargs))
+        return Column(name, *args, **kwargs)
+    return column
+
+
+class AddressMixin(object):
+    family = socket.AF_INET
+
+    # Packed network-order address; rdata keeps the normalized text form.
+    address = record_column('address', LargeBinary(16), index=True)
+
+    @property
+    def ip(self):
+        return self.rdata
+
+    @ip.setter
+    def ip(self, value):
+        self.address = socket.inet_pton(self.family, value)
+        self.rdata = socket.inet_ntop(self.family, self.address)
+
+    def parse_rdata(self, rdata):
+        self.ip = rdata
+
 
-class RecordA(Record):
-    __tablename__ = 'record_a'
+class RecordA(AddressMixin, Record):
+    __tablename__ = record_table('record_a')
 
     __mapper_args__ = {
         'polymorphic_identity': 'A',
@@ -203,56 +393,42 @@ class RecordA(Record):
     def __init__(self, domain, name, ip, memo=u'', ttl=3600):
         self.domain = domain
         self.name = name
-        self.rdata = ip
+        self.ip = ip
         self.ttl = ttl
         self.cls = 0
         self.type = u'A'
         self.memo = memo
 
-    id = Column(Integer, ForeignKey('record.id'), primary_key=True)
+    id = record_id()
     domain = relationship(Domain, backref='a')
-    memo = Column(UnicodeText, default=u'')
+    memo = record_column('memo', UnicodeText, default=u'')
 
-    @property
-    def ip(self):
-        return self.rdata
-
-    @ip.setter
-    def ip(self, value):
-        self.rdata = value
 
-
-class RecordAAAA(Record):
-    __tablename__ = 'record_aaaa'
+class RecordAAAA(AddressMixin, Record):
+    __tablename__ = record_table('record_aaaa')
 
     __mapper_args__ = {
         'polymorphic_identity': 'AAAA',
     }
 
+    family = socket.AF_INET6
+
     def __init__(self, domain, name, ip, memo=u'', ttl=3600):
         self.domain = domain
         self.name = name
-        self.rdata = ip
+        self.ip = ip
         self.ttl = ttl
         self.cls = 0
         self.type = u'AAAA'
         self.memo = memo
 
-    id = Column(Integer, ForeignKey('record.id'), primary_key=True)
+    id = record_id()
     domain = relationship(Domain, backref='aaaa')
-    memo = Column(UnicodeText, default=u'')
-
-    @property
-    def ip(self):
-        return self.rdata
-
-    @ip.setter
-    def ip(self, value):
-        self.rdata = value
+    memo = record_column('memo', UnicodeText, default=u'')
 
 
 class RecordCNAME(Record):
-    __tablename__ = 'record_cname'
+    __tablename__ = record_table('record_cname')
 
     __mapper_args__ = {
         'polymorphic_identity': 'CNAME',
@@ -267,9 +443,9 @@ class RecordCNAME(Record):
         self.type = u'CNAME'
         self.memo = memo
 
-    id = Column(Integer, ForeignKey('record.id'), primary_key=True)
+    id = record_id()
     domain = relationship(Domain, backref='cname')
-    memo = Column(UnicodeText, default=u'')
+    memo = record_column('memo', UnicodeText, default=u'')
 
     @property
     def target(self):
@@ -281,7 +457,7 @@ class RecordCNAME(Record):
 
 
 class RecordMX(Record):
-    __tablename__ = 'record_mx'
+    __tablename__ = record_table('record_mx')
 
     __mapper_args__ = {
         'polymorphic_identity': 'MX',
@@ -297,42 +473,29 @@ class RecordMX(Record):
         self.type = u'MX'
         self.memo = memo
 
-    id = Column(Integer, ForeignKey('record.id'), primary_key=True)
+    id = record_id()
     domain = relationship(Domain, backref='mx')
-    memo = Column(UnicodeText, default=u'')
-
-    @property
-    def preference(self):
-        if not isinstance(self.rdata, basestring):
-            print([self.rdata])
-            return 2
-        rdata = self.rdata.split(' ', 1)
-        if len(rdata) != 2:
-            return 3
-
-        return int(rdata[0])
-
-    @preference.setter
-    def preference(self, value):
-        self.rdata = '%d %s' % (value, self.target)
-
-    @property
-    def target(self):
-        if not isinstance(self.rdata, basestring):
-            return ''
-        rdata = self.rdata.split(' ', 1)
-        if len(rdata) != 2:
-            return ''
-
-        return rdata[1]
-
-    @target.setter
-    def target(self, value):
-        self.rdata = '%d %s' % (self.preference, value)
+    memo = record_column('memo', UnicodeText, default=u'')
+
+    preference = record_column('preference', Integer, index=True)
+    target = record_column('target', String(255), index=True)
+
+    @validates('preference', 'target')
+    def validate_rdata(self, key, value):
+        values = {'preference': self.preference, 'target': self.target}
+        values[key] = value
+        if values['preference'] is not None and values['target'] is not None:
+            self.rdata = '%d %s' % (values['preference'], values['target'])
+        return value
+
+    def parse_rdata(self, rdata):
+        preference, target = rdata.split(' ', 1)
+        self.preference = int(preference)
+        self.target = target
 
 
 class RecordTXT(Record):
-    __tablename__ = 'record_txt'
+    __tablename__ = record_table('record_txt')
 
     __mapper_args__ = {
         'polymorphic_identity': 'TXT',
@@ -347,21 +510,23 @@ class RecordTXT(Record):
         self.type = u'TXT'
         self.memo = memo
 
-    id = Column(Integer, ForeignKey('record.id'), primary_key=True)
+    id = record_id()
     domain = relationship(Domain, backref='txt')
-    memo = Column(UnicodeText, default=u'')
+    memo = record_column('memo', UnicodeText, default=u'')
 
-    @property
-    def txt(self):
-        return self.rdata
+    txt = record_column('txt', String(255))
 
-    @txt.setter
-    def txt(self, value):
-        self.rdata = value
+    @validates('txt')
+    def validate_txt(self, key, value):
+        self.rdata = quote_txt(value)
+        return value
+
+    def parse_rdata(self, rdata):
+        self.txt = unquote_txt(rdata)
 
 
 class RecordNS(Record):
-    __tablename__ = 'record_ns'
+    __tablename__ = record_table('record_ns')
 
     __mapper_args__ = {
         'polymorphic_identity': 'NS',
@@ -376,9 +541,9 @@ class RecordNS(Record):
         self.type = u'NS'
         self.memo = memo
 
-    id = Column(Integer, ForeignKey('record.id'), primary_key=True)
+    id = record_id()
     domain = relationship(Domain, backref='ns')
-    memo = Column(UnicodeText, default=u'')
+    memo = record_column('memo', UnicodeText, default=u'')
 
     @property
     def target(self):
@@ -390,7 +555,7 @@ class RecordNS(Record):
 
 
 class RecordServiceNameServer(Record):
-    __tablename__ = 'record_servicenameserver'
+    __tablename__ = record_table('record_servicenameserver')
 
     __mapper_args__ = {
         'polymorphic_identity': 'servicenameserver',
@@ -405,14 +570,15 @@ class RecordServiceNameServer(Record):
         self.type = u'NS'
         self.nameserver = nameserver
 
-    id = Column(Integer, ForeignKey('record.id'), primary_key=True)
+    id = record_id()
 
-    nameserver_id = Column(Integer, ForeignKey('nameserver.id'), nullable=False)
+    nameserver_id = record_column('nameserver_id', Integer,
+                                  ForeignKey('nameserver.id'), nullable=False)
     nameserver = relationship(NameServer)
 
 
-class RecordDDNS_A(Record):
-    __tablename__ = 'record_ddns_a'
+class RecordDDNS_A(AddressMixin, Record):
+    __tablename__ = record_table('record_ddns_a')
 
     __mapper_args__ = {
         'polymorphic_identity': 'ddns_a',
@@ -421,31 +587,52 @@ class RecordDDNS_A(Record):
     def __init__(self, domain, name, ip, memo, ttl=300):
         self.domain = domain
         self.name = name
-        self.rdata = ip
+        self.ip = ip
         self.ttl = ttl
         self.cls = 0
         self.type = u'A'
         self.ddns_key = random_string(10)
         self.memo = memo
 
-    id = Column(Integer, ForeignKey('record.id'), primary_key=True)
-    ddns_key = Column(Unicode(80), nullable=False)
-    memo = Column(UnicodeText, default=u'')
+    id = record_id()
+    ddns_key = record_column('ddns_key', Unicode(80), nullable=False,
+                             index=True)
+    memo = record_column('memo', UnicodeText, default=u'')
 
-    @property
-    def ip(self):
-        return self.rdata
+    def reset_key(self):
+        self.ddns_key = random_string(10)
 
-    @ip.setter
-    def ip(self, value):
-        self.rdata = value
+
+class RecordDDNS_AAAA(AddressMixin, Record):
+    __tablename__ = record_table('record_ddns_aaaa')
+
+    __mapper_args__ = {
+        'polymorphic_identity': 'ddns_aaaa',
+    }
+
+    family = socket.AF_INET6
+
+    def __init__(self, domain, name, ip, memo, ddns_key=None, ttl=300):
+        self.domain = domain
+        self.name = name
+        self.ip = ip
+        self.ttl = ttl
+        self.cls = 0
+        self.type = u'AAAA'
+        self.ddns_key = ddns_key or random_string(10)
+        self.memo = memo
+
+    id = record_id()
+    ddns_key = record_column('ddns_key', Unicode(80), nullable=False,
+                             index=True)
+    memo = record_column('memo', UnicodeText, default=u'')
 
     def reset_key(self):
         self.ddns_key = random_string(10)
 
 
 class RecordWebForwarding(Record):
-    __tablename__ = 'record_webforwarding'
+    __tablename__ = record_table('record_webforwarding')
 
     __mapper_args__ = {
         'polymorphic_identity': 'webforwarding',
@@ -462,16 +649,18 @@ class RecordWebForwarding(Record):
         self.forwarding_type = type
 
 
-    id = Column(Integer, ForeignKey('record.id'), primary_key=True)
+    id = record_id()
 
-    forwarding_target = Column(String(1024), nullable=False)
-    forwarding_type = Column(String(32), nullable=False, default='iframe')
+    forwarding_target = record_column('forwarding_target', String(1024),
+                                      nullable=False)
+    forwarding_type = record_column('forwarding_type', String(32),
+                                    nullable=False, default='iframe')
 
-    memo = Column(UnicodeText, default=u'')
+    memo = record_column('memo', UnicodeText, default=u'')
 
 
 class RecordWebParking(Record):
-    __tablename__ = 'record_webparking'
+    __tablename__ = record_table('record_webparking')
 
     __mapper_args__ = {
         'polymorphic_identity': 'webparking',
@@ -488,20 +677,117 @@ class RecordWebParking(Record):
         self.parking_data = u''
 
 
-    id = Column(Integer, ForeignKey('record.id'), primary_key=True)
+    id = record_id()
+
+    parking_type = record_column('parking_type', String(32), nullable=False,
+                                 default='default')
+    parking_data = record_column('parking_data', UnicodeText, default=u'')
+
+    memo = record_column('memo', UnicodeText, default=u'')
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in sorted(sqlite_pragmas.items()):
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
 
-    parking_type = Column(String(32), nullable=False, default='default')
-    parking_data = Column(UnicodeText, default=u'')
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        # The pool discards this connection and checks out another.
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
 
-    memo = Column(UnicodeText, default=u'')
 
+def create_database_engine(url):
+    if make_url(url).drivername.startswith('sqlite'):
+        engine = create_engine(url)
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+    else:
+        engine = create_engine(url,
+                               pool_size=database_pool_size,
+                               max_overflow=database_max_overflow,
+                               pool_recycle=database_pool_recycle)
+        # Autocommit sessions check a connection out per statement, so a
+        # ping is only worth it where connections can go away.
+        if database_pool_pre_ping:
+            event.listen(engine, 'checkout', ping_connection)
+    return engine
 
-engine = create_engine(database_url, pool_recycle=300)
 
-Session = sessionmaker(autocommit=True)
+class RoutingSession(BaseSession):
+    replica = None
+    use_replica = False
+
+    def get_bind(self, mapper=None, clause=None):
+        # Reads outside session.begin() may use the replica; flushes and
+        # everything inside an explicit transaction stay on the primary.
+        if self.use_replica and self.replica is not None and \
+                self.transaction is None:
+            return self.replica
+        return BaseSession.get_bind(self, mapper, clause)
+
+
+engine = create_database_engine(database_url)
+
+if database_replica_url:
+    RoutingSession.replica = create_database_engine(database_replica_url)
+
+Session = sessionmaker(class_=RoutingSession, autocommit=True)
 Session.configure(bind=engine)
 
 
+def journal_change(domain, action, old=None, new=None):
+    return {'domain_id': domain.id,
+            'domain_name': domain.name,
+            'serial': domain.update_serial or 1,
+            'action': action,
+            'old': old,
+            'new': new}
+
+
+@event.listens_for(Session, 'after_flush')
+def journal_record_changes(session, flush_context):
+    zones, changes, serials = [], [], []
+    for obj in session.new:
+        if isinstance(obj, Domain):
+            zones.append(journal_change(obj, 'insert'))
+            serials.append(journal_change(obj, 'serial'))
+        elif isinstance(obj, Record):
+            changes.append(journal_change(obj.domain, 'insert', new=obj.line))
+
+    for obj in session.dirty:
+        if not session.is_modified(obj):
+            continue
+        if isinstance(obj, Domain):
+            if get_history(obj, 'update_serial').deleted:
+                serials.append(journal_change(obj, 'serial'))
+        elif isinstance(obj, Record):
+            # A TTL-only edit journals the unchanged line so that IXFR
+            # resends it with the new TTL.
+            old, new = obj.committed_line, obj.line
+            if old != new or get_history(obj, 'ttl').deleted:
+                changes.append(journal_change(obj.domain, 'update',
+                                              old=old, new=new))
+
+    for obj in session.deleted:
+        if isinstance(obj, Domain):
+            changes.append(journal_change(obj, 'delete'))
+        elif isinstance(obj, Record):
+            changes.append(journal_change(obj.domain, 'delete',
+                                          old=obj.committed_line))
+
+    changes = zones + changes + serials
+    if changes:
+        session.connection().execute(RecordChange.__table__.insert(),
+                                     changes)
+
+
 def db_install():
     Base.metadata.create_all(engine)
 
@@ -532,6 +818,85 @@ class UserTestCase(unittest.TestCase):
         Base.metadata.drop_all(engine)
 
 
+class RoutingSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        _, self.replica_path = tempfile.mkstemp()
+        self.replica = create_database_engine('sqlite:///' +
+                                              self.replica_path)
+        Base.metadata.create_all(self.replica)
+        self.replica.execute(Domain.__table__.insert(),
+                             name='replica.kr', update_serial=1)
+
+    def test_sqlite_pragmas(self):
+        self.assertEqual(engine.execute('PRAGMA journal_mode').scalar(),
+                         'wal')
+
+    def test_routing_session(self):
+        s = Session()
+        s.replica = self.replica
+        s.use_replica = True
+
+        with s.begin():
+            s.add(Domain(name='primary.kr'))
+
+        self.assertEqual([name for name, in s.query(Domain.name)],
+                         ['replica.kr'])
+        with s.begin():
+            self.assertEqual([name for name, in s.query(Domain.name)],
+                             ['primary.kr'])
+
+        s.use_replica = False
+        self.assertEqual([name for name, in s.query(Domain.name)],
+                         ['primary.kr'])
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
+        self.replica.dispose()
+        os.remove(self.replica_path)
+
+
+class TokenTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+
+    def test_token(self):
+        s = Session()
+        user = User(name='dnsforever',
+                    email='test@dnsforever.kr',
+                    password='test')
+        fp = FindPasswd(user=user)
+        expired = FindPasswd(user=user)
+        expired.expires_at = datetime.utcnow() - timedelta(seconds=1)
+
+        with s.begin():
+            s.add(fp)
+            s.add(expired)
+
+        self.assertNotEqual(fp.token_hash, fp.token)
+        self.assertEqual(FindPasswd.find_token(s, unicode(fp.token)), fp)
+        self.assertIsNone(FindPasswd.find_token(s, expired.token))
+        self.assertIsNone(FindPasswd.find_token(s, fp.token_hash))
+        self.assertIsNone(EmailValidation.find_token(s, fp.token))
+
+    def test_subdomain_sharing(self):
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        ticket = SubdomainSharing(domain=domain, name='www',
+                                  email=u'test@dnsforever.kr')
+
+        with s.begin():
+            s.add(ticket)
+
+        self.assertEqual(SubdomainSharing.for_email(s, u'test@dnsforever.kr')
+                                         .all(), [ticket])
+        self.assertEqual(SubdomainSharing.for_email(s, u'%@dnsforever.kr')
+                                         .all(), [])
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
+
+
 class DomainTestCase(unittest.TestCase):
     def setUp(self):
         Base.metadata.create_all(engine)
@@ -697,6 +1062,25 @@ class RecordTestCase(unittest.TestCase):
         key2 = record.ddns_key
         self.assertNotEqual(key1, key2)
 
+    def test_record_ddns_aaaa(self):
+        s = Session()
+        domain = s.query(Domain).filter(User.id==self.domain_id).first()
+        self.assertIsNotNone(domain)
+
+        record = RecordDDNS_AAAA(domain=domain, name='ddnsaaaa', ip='::1',
+                                 memo=u'', ddns_key=u'abcdefghij')
+
+        with s.begin():
+            s.add(record)
+
+        record = s.query(Record).filter(Record.domain==domain)\
+                                .filter(Record.name=='ddnsaaaa').first()
+
+        self.assertEqual(record.type, 'AAAA')
+        self.assertEqual(record.rdata, '::1')
+        self.assertEqual(record.ddns_key, 'abcdefghij')
+        self.assertEqual(record.service, 'ddns_aaaa')
+
     def test_record_webforwarding(self):
         s = Session()
         domain = s.query(Domain).filter(User.id==self.domain_id).first()
@@ -738,3 +1122,65 @@ class RecordTestCase(unittest.TestCase):
         Base.metadata.drop_all(engine)
 
 
+class RecordChangeTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+
+        with s.begin():
+            s.add(domain)
+
+        self.domain_id = domain.id
+
+    def test_record_change(self):
+        s = Session()
+        domain = s.query(Domain).filter(Domain.id==self.domain_id).first()
+
+        record = RecordA(domain=domain, name='test', ip='127.0.0.1')
+        with s.begin():
+            record.update()
+            s.add(record)
+
+        with s.begin():
+            record.ip = '127.0.0.2'
+            record.update()
+
+        with s.begin():
+            record.update()
+            s.delete(record)
+
+        changes = s.query(RecordChange).order_by(RecordChange.id).all()
+        changes = [(change.action, change.old, change.new)
+                   for change in changes if change.action != 'serial']
+        self.assertEqual(changes,
+                         [('insert', None, None),
+                          ('insert', None, 'test A 127.0.0.1'),
+                          ('update', 'test A 127.0.0.1', 'test A 127.0.0.2'),
+                          ('delete', 'test A 127.0.0.2', None)])
+
+        serial = s.query(RecordChange.serial)\
+                  .order_by(RecordChange.id.desc()).first()
+        self.assertEqual(serial, (4,))
+
+    def test_ttl_change(self):
+        s = Session()
+        domain = s.query(Domain).filter(Domain.id==self.domain_id).first()
+
+        record = RecordA(domain=domain, name='test', ip='127.0.0.1')
+        with s.begin():
+            s.add(record)
+
+        with s.begin():
+            record.ttl = 3600
+        with s.begin():
+            record.ttl = 300
+
+        changes = s.query(RecordChange.action, RecordChange.old,
+                          RecordChange.new)\
+                   .filter(RecordChange.action == 'update').all()
+        self.assertEqual(changes,
+                         [('update', 'test A 127.0.0.1', 'test A 127.0.0.1')])
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
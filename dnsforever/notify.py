@@ -0,0 +1,124 @@
+import socket
+import struct
+import random
+import unittest
+from threading import Condition
+
+from sqlalchemy import event, select
+from sqlalchemy.orm.attributes import get_history
+
+from dnsforever.config import notify_enabled, notify_port
+from dnsforever.models import Base, Session, Domain, NameServer, engine
+
+OPCODE_NOTIFY = 4
+FLAG_AA = 0x0400
+TYPE_SOA = 6
+CLASS_IN = 1
+
+zone_changed = Condition()
+
+
+def notify_packet(domain, message_id=None):
+    if message_id is None:
+        message_id = random.randint(0, 0xffff)
+
+    header = struct.pack('!HHHHHH', message_id,
+                         (OPCODE_NOTIFY << 11) | FLAG_AA, 1, 0, 0, 0)
+    qname = ''.join(chr(len(label)) + label
+                    for label in domain.encode('ascii').split('.') if label)
+    return header + qname + '\0' + struct.pack('!HH', TYPE_SOA, CLASS_IN)
+
+
+def send_notify(domains, addresses):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setblocking(0)
+    try:
+        for domain in domains:
+            packet = notify_packet(domain)
+            for address in addresses:
+                try:
+                    s.sendto(packet, address)
+                except socket.error:
+                    continue
+    finally:
+        s.close()
+
+
+def nameserver_addresses(bind):
+    nameserver = NameServer.__table__
+    rows = bind.execute(select([nameserver.c.ip]))
+    return [(ip, notify_port) for ip, in rows]
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_updated_domains(session, flush_context):
+    # Added and removed zones are news to the nameservers too.
+    domains = [obj for obj in session.new if isinstance(obj, Domain)]
+    domains.extend(obj for obj in session.deleted if isinstance(obj, Domain))
+    domains.extend(obj for obj in session.dirty
+                   if isinstance(obj, Domain) and
+                   get_history(obj, 'update_serial').deleted)
+    if domains:
+        session.info.setdefault('updated_domains', set())\
+                    .update(domain.name for domain in domains)
+
+
+@event.listens_for(Session, 'after_commit')
+def notify_updated_domains(session):
+    domains = session.info.pop('updated_domains', None)
+    if not domains:
+        return
+
+    with zone_changed:
+        zone_changed.notify_all()
+
+    if notify_enabled:
+        send_notify(domains, nameserver_addresses(session.get_bind()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_updated_domains(session):
+    session.info.pop('updated_domains', None)
+
+
+def wait_for_change(timeout):
+    with zone_changed:
+        zone_changed.wait(timeout)
+
+
+class NotifyTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.settimeout(1)
+
+    def test_notify_packet(self):
+        packet = notify_packet('dnsforever.kr', 1234)
+        self.assertEqual(packet[:12], '\x04\xd2\x24\x00\0\x01\0\0\0\0\0\0')
+        self.assertEqual(packet[12:], '\x0adnsforever\x02kr\0\0\x06\0\x01')
+
+    def test_send_notify(self):
+        send_notify(['dnsforever.kr'], [self.listener.getsockname()])
+        packet, _ = self.listener.recvfrom(512)
+        self.assertEqual(packet[2:], notify_packet('dnsforever.kr', 0)[2:])
+
+    def test_collect_updated_domains(self):
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        with s.begin():
+            s.add(domain)
+            s.flush()
+            self.assertEqual(s.info['updated_domains'],
+                             set(['dnsforever.kr']))
+
+        with s.begin():
+            s.delete(domain)
+            s.flush()
+            self.assertEqual(s.info['updated_domains'],
+                             set(['dnsforever.kr']))
+        self.assertNotIn('updated_domains', s.info)
+
+    def tearDown(self):
+        self.listener.close()
+        Base.metadata.drop_all(engine)
@@ -0,0 +1,192 @@
+import unittest
+from collections import OrderedDict
+
+from sqlalchemy import Column, MetaData, inspect, select, not_
+
+from dnsforever.backfill import add_columns
+from dnsforever.config import record_layout
+from dnsforever.models import Base, Session, engine, Domain, Record, \
+    RecordA, RecordMX
+
+
+def record_mappers():
+    return [mapper for identity, mapper in
+            sorted(Record.__mapper__.polymorphic_map.items())
+            if identity is not None]
+
+
+def type_columns(mapper):
+    base = set(prop.key for prop in Record.__mapper__.column_attrs)
+    return [prop.columns[0].name for prop in mapper.column_attrs
+            if prop.key not in base]
+
+
+def joined_table_name(mapper):
+    # Every record type is named record_<identity> in the joined layout.
+    return 'record_%s' % mapper.polymorphic_identity.lower()
+
+
+def single_record_table():
+    # The record table as the single layout maps it, in either layout.
+    table = Record.__table__.tometadata(MetaData())
+    for mapper in record_mappers():
+        for column in mapper.local_table.c:
+            if column.name not in table.c:
+                table.append_column(Column(column.name, column.type,
+                                           nullable=True,
+                                           index=column.index))
+    return table
+
+
+def migrate_to_single(engine, drop=False):
+    record = single_record_table()
+    existing = MetaData()
+    existing.reflect(engine)
+
+    columns = [column.name for column in record.c
+               if column.name not in existing.tables['record'].c]
+    add_columns(engine, record, columns)
+
+    moved = OrderedDict()
+    connection = engine.connect()
+    try:
+        for mapper in record_mappers():
+            source = existing.tables.get(joined_table_name(mapper))
+            if source is None:
+                continue
+
+            names = [name for name in type_columns(mapper)
+                     if name in source.c]
+            values = dict((name, select([source.c[name]])
+                                 .where(source.c.id == record.c.id)
+                                 .as_scalar())
+                          for name in names)
+            with connection.begin():
+                if values:
+                    result = connection.execute(
+                        record.update()
+                              .where(record.c.id.in_(select([source.c.id])))
+                              .values(**values))
+                    moved[mapper.polymorphic_identity] = result.rowcount
+                # Rows left behind would come back stale on the way back
+                # to the joined layout.
+                if drop:
+                    source.drop(connection)
+                else:
+                    connection.execute(source.delete())
+    finally:
+        connection.close()
+    return moved
+
+
+def migrate_to_joined(engine):
+    Base.metadata.create_all(engine)
+    existing = MetaData()
+    existing.reflect(engine)
+    source = existing.tables['record']
+
+    moved = OrderedDict()
+    connection = engine.connect()
+    try:
+        for mapper in record_mappers():
+            table = mapper.local_table
+            names = ['id'] + [name for name in type_columns(mapper)
+                              if name in source.c]
+            rows = select([source.c[name] for name in names])\
+                .where(source.c.service == mapper.polymorphic_identity)\
+                .where(not_(source.c.id.in_(select([table.c.id]))))
+            with connection.begin():
+                result = connection.execute(
+                    table.insert().from_select(names, rows))
+            moved[mapper.polymorphic_identity] = result.rowcount
+    finally:
+        connection.close()
+    return moved
+
+
+def migrate_records(engine, drop=False):
+    if record_layout == 'single':
+        return migrate_to_single(engine, drop)
+    return migrate_to_joined(engine)
+
+
+@unittest.skipIf(record_layout != 'joined', 'joined record layout only')
+class MigrateRecordsTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+
+    def test_migrate_to_joined(self):
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        with s.begin():
+            s.add(domain)
+
+        # A record written by the single-table layout: type columns live
+        # in the record table and there is no record_a row.
+        engine.execute('ALTER TABLE record ADD COLUMN address BLOB')
+        engine.execute('ALTER TABLE record ADD COLUMN memo TEXT')
+        engine.execute(Record.__table__.insert()
+                             .values(id=1, service='A', domain_id=domain.id,
+                                     name='www', type='A', cls=0, ttl=3600,
+                                     rdata='127.0.0.1'))
+        engine.execute("UPDATE record SET address = x'7f000001', "
+                       "memo = 'web' WHERE id = 1")
+
+        self.assertEqual(migrate_records(engine)['A'], 1)
+        self.assertEqual(migrate_records(engine)['A'], 0)
+
+        record = s.query(RecordA).one()
+        self.assertEqual((record.ip, record.memo, record.address),
+                         ('127.0.0.1', 'web', '\x7f\x00\x00\x01'))
+
+    def test_single_record_table(self):
+        table = single_record_table()
+        for name in ('address', 'memo', 'preference', 'target', 'txt',
+                     'ddns_key'):
+            self.assertTrue(table.c[name].nullable)
+        self.assertIn('ix_record_address',
+                      [index.name for index in table.indexes])
+
+    def test_migrate_to_single(self):
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        with s.begin():
+            s.add(RecordA(domain=domain, name='www', ip='127.0.0.1'))
+            s.add(RecordMX(domain=domain, name=None, preference=10,
+                           target='mx.dnsforever.kr'))
+
+        moved = migrate_to_single(engine, drop=True)
+        self.assertEqual((moved['A'], moved['MX']), (1, 1))
+        self.assertNotIn('record_a', inspect(engine).get_table_names())
+
+        record = single_record_table()
+        self.assertEqual(sorted(engine.execute(
+            select([record.c.type, record.c.address, record.c.preference,
+                    record.c.target]))),
+            [('A', '\x7f\x00\x00\x01', None, None),
+             ('MX', None, 10, 'mx.dnsforever.kr')])
+
+    def test_migrate_round_trip(self):
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        with s.begin():
+            s.add(RecordA(domain=domain, name='www', ip='127.0.0.1',
+                          memo=u'web'))
+
+        migrate_to_single(engine)
+        self.assertEqual(engine.execute(RecordA.__table__.count()).scalar(),
+                         0)
+
+        # An edit made while the single layout was in use.
+        record = single_record_table()
+        engine.execute(record.update().values(rdata='127.0.0.2',
+                                              address='\x7f\x00\x00\x02',
+                                              memo=u'edited'))
+
+        self.assertEqual(migrate_to_joined(engine)['A'], 1)
+        record = s.query(RecordA).one()
+        self.assertEqual((record.ip, record.memo, record.address),
+                         ('127.0.0.2', 'edited', '\x7f\x00\x00\x02'))
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
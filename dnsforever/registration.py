@@ -0,0 +1,115 @@
+import unittest
+
+from dnsforever.domain import PUBLIC_SUFFIXES, domain_suffixes
+from dnsforever.models import Base, Session, engine, User, Domain, \
+    DomainOwnership
+
+STATUS_OK = 'ok'
+STATUS_INVALID = 'invalid'
+STATUS_DUPLICATE = 'duplicate'
+STATUS_CONFLICT = 'conflict'
+
+# SQLite refuses more than 999 bound parameters per statement.
+QUERY_CHUNK_SIZE = 500
+
+
+def normalize_domain(name):
+    try:
+        name = str(name).strip().lower()
+    except (UnicodeError, ValueError):
+        return None
+    if not Domain.DOMAIN_PATTERN.match(name):
+        return None
+    return name
+
+
+def existing_domains(session, names):
+    names = list(names)
+    existing = set()
+    for i in xrange(0, len(names), QUERY_CHUNK_SIZE):
+        chunk = names[i:i + QUERY_CHUNK_SIZE]
+        existing.update(name for name, in
+                        session.query(Domain.name)
+                               .filter(Domain.name.in_(chunk)))
+    return existing
+
+
+def register_domains(session, user, names):
+    results = []
+    candidates = []
+    seen = set()
+    for name in names:
+        domain = normalize_domain(name)
+        registrable_domain = None
+        if domain is not None:
+            registrable_domain = PUBLIC_SUFFIXES.registrable_domain(domain)
+
+        if registrable_domain is None:
+            results.append([name, STATUS_INVALID])
+        elif domain in seen:
+            results.append([name, STATUS_DUPLICATE])
+        else:
+            seen.add(domain)
+            result = [domain, STATUS_OK]
+            results.append(result)
+            candidates.append((result,
+                               domain_suffixes(domain, registrable_domain)))
+
+    existing = existing_domains(session, set(suffix
+                                             for _, suffixes in candidates
+                                             for suffix in suffixes))
+
+    accepted = []
+    for result, suffixes in candidates:
+        if any(suffix in existing for suffix in suffixes):
+            result[1] = STATUS_CONFLICT
+            continue
+        # A parent accepted earlier in the same batch owns this name too.
+        existing.add(result[0])
+        accepted.append(result[0])
+
+    if accepted:
+        with session.begin():
+            session.add_all(DomainOwnership(master=True, user=user,
+                                            domain=Domain(name=domain))
+                            for domain in accepted)
+
+    return [tuple(result) for result in results]
+
+
+class RegisterDomainsTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        s = Session()
+        with s.begin():
+            s.add(Domain(name='dnsforever.kr'))
+
+    def test_register_domains(self):
+        s = Session()
+        with s.begin():
+            user = User(name=u'dnsforever', email=u'test@dnsforever.kr',
+                        password='test')
+            s.add(user)
+
+        results = register_domains(s, user, ['Example.kr', 'example.kr',
+                                             'www.dnsforever.kr', 'co.kr',
+                                             'not_a_domain', 'a.example.kr',
+                                             'example.co.kr'])
+        self.assertEqual(results, [('example.kr', STATUS_OK),
+                                   ('example.kr', STATUS_DUPLICATE),
+                                   ('www.dnsforever.kr', STATUS_CONFLICT),
+                                   ('co.kr', STATUS_INVALID),
+                                   ('not_a_domain', STATUS_INVALID),
+                                   ('a.example.kr', STATUS_CONFLICT),
+                                   ('example.co.kr', STATUS_OK)])
+
+        user_id = user.id
+        s = Session()
+        self.assertEqual(sorted(name for name, in
+                                s.query(Domain.name)
+                                 .join(DomainOwnership)
+                                 .filter(DomainOwnership.user_id == user_id)),
+                         ['example.co.kr', 'example.kr'])
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
@@ -0,0 +1,156 @@
+import logging
+import time
+import unittest
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+
+from sqlalchemy import select, func
+
+from dnsforever.config import token_sweep_interval, \
+    token_sweep_batch_size, mail_sent_lifetime, record_change_lifetime
+from dnsforever.models import Base, Session, engine, User, Domain, \
+    EmailValidation, FindPasswd, SubdomainSharing, ApiToken, OutboxEmail, \
+    RecordChange, RecordA
+
+SWEPT_MODELS = (EmailValidation, FindPasswd, SubdomainSharing, ApiToken)
+
+logger = logging.getLogger(__name__)
+
+
+def sweep_expired(connection, model, now=None,
+                  batch_size=token_sweep_batch_size, column='expires_at',
+                  below_id=None):
+    table = model.__table__
+    column = table.c[column]
+    now = now or datetime.utcnow()
+
+    query = select([table.c.id]).where(column <= now)
+    if below_id is not None:
+        query = query.where(table.c.id < below_id)
+
+    removed = 0
+    while True:
+        ids = [id for id, in
+               connection.execute(query.order_by(column).limit(batch_size))]
+        if not ids:
+            break
+
+        # One short transaction per batch keeps the table lock brief.
+        with connection.begin():
+            connection.execute(table.delete().where(table.c.id.in_(ids)))
+        removed += len(ids)
+
+        if len(ids) < batch_size:
+            break
+    return removed
+
+
+def sweep_all(batch_size=token_sweep_batch_size):
+    now = datetime.utcnow()
+    connection = engine.connect()
+    try:
+        removed = OrderedDict((model.__tablename__,
+                               sweep_expired(connection, model, now,
+                                             batch_size))
+                              for model in SWEPT_MODELS)
+        removed[OutboxEmail.__tablename__] = sweep_expired(
+            connection, OutboxEmail,
+            now - timedelta(seconds=mail_sent_lifetime), batch_size,
+            column='sent_at')
+
+        # The newest change is kept so that its id is never reused and the
+        # change sequence nameservers follow never goes back.
+        newest = connection.execute(select([func.max(RecordChange.id)]))\
+                           .scalar()
+        removed[RecordChange.__tablename__] = sweep_expired(
+            connection, RecordChange,
+            now - timedelta(seconds=record_change_lifetime), batch_size,
+            column='created_at', below_id=newest or 0)
+        return removed
+    finally:
+        connection.close()
+
+
+class Sweeper(object):
+    def __init__(self, interval=token_sweep_interval):
+        self.interval = interval
+        self.lock = Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                sweep_all()
+            except Exception:
+                logger.exception('Sweeping expired rows failed')
+
+
+class SweeperTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+
+    def test_sweep_all(self):
+        s = Session()
+        past = datetime.utcnow() - timedelta(seconds=1)
+        user = User(name='dnsforever',
+                    email='test@dnsforever.kr',
+                    password='test')
+        domain = Domain(name='dnsforever.kr')
+
+        with s.begin():
+            for i in xrange(5):
+                ev = EmailValidation(user=user)
+                ev.expires_at = past
+                s.add(ev)
+            s.add(EmailValidation(user=user))
+            s.add(FindPasswd(user=user))
+            ticket = SubdomainSharing(domain=domain, name='www',
+                                      email=u'a@dnsforever.kr')
+            ticket.expires_at = past
+            s.add(ticket)
+            s.add(OutboxEmail(to=u'a@dnsforever.kr', subject=u'', body=u'',
+                              sent_at=past - timedelta(
+                                  seconds=mail_sent_lifetime)))
+            s.add(OutboxEmail(to=u'b@dnsforever.kr', subject=u'', body=u'',
+                              sent_at=past))
+
+        self.assertEqual(sweep_all(batch_size=2),
+                         OrderedDict([('email_validation', 5),
+                                      ('findpasswd', 0),
+                                      ('subdomain_sharing', 1),
+                                      ('api_token', 0),
+                                      ('outbox_email', 1),
+                                      ('record_change', 0)]))
+        self.assertEqual(s.query(EmailValidation).count(), 1)
+        self.assertEqual(s.query(FindPasswd).count(), 1)
+        self.assertEqual(s.query(SubdomainSharing).count(), 0)
+        self.assertEqual(s.query(OutboxEmail.to).all(),
+                         [(u'b@dnsforever.kr',)])
+
+    def test_sweep_record_changes(self):
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        with s.begin():
+            s.add(RecordA(domain=domain, name='www', ip='127.0.0.1'))
+        with s.begin():
+            s.add(RecordA(domain=domain, name='ftp', ip='127.0.0.2'))
+        past = datetime.utcnow() - timedelta(seconds=record_change_lifetime,
+                                             minutes=1)
+        engine.execute(RecordChange.__table__.update()
+                                             .values(created_at=past))
+        newest = s.query(func.max(RecordChange.id)).scalar()
+
+        self.assertEqual(sweep_all()['record_change'], newest - 1)
+        self.assertEqual(s.query(RecordChange.id).all(), [(newest,)])
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
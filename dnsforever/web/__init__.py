@@ -1,34 +1,55 @@
-from flask import Flask, g
+from flask import Flask, g, request
 
-from dnsforever.config import secret_key
+from dnsforever.config import secret_key, token_sweep_interval, page_size
 from dnsforever.models import Session
-from dnsforever.web.tools.session import get_user
+from dnsforever.sweeper import Sweeper
+from dnsforever.web.email import wake_mail_sender
+from dnsforever.web.tools.session import get_user, get_domain_names
+from dnsforever.web.metrics import instrument
 
 
 blueprints = ['apis', 'index', 'account', 'domain',
               'domain_a', 'domain_ddns', 'domain_aaaa',
               'domain_cname', 'domain_mx',
-              'domain_txt', 'domain_subdomain']
+              'domain_txt', 'domain_subdomain', 'metrics']
+
+# Read-heavy GET endpoints whose queries may be served by the replica.
+# Pages users are redirected to after an edit must not lag behind it.
+replica_endpoints = ['apis.serverupdate']
+
+sweeper = Sweeper()
 
 
 def create_app():
     app = Flask(__name__)
     app.secret_key = secret_key
+    instrument(app)
 
     for name in blueprints:
         app.register_blueprint(load_blueprint(name))
 
+    # Only a process that serves requests runs the background sweeper and
+    # mail sender; manage.py commands create the app too. Waking the sender
+    # picks up retries queued before a restart.
+    @app.before_first_request
+    def start_background_threads():
+        if token_sweep_interval > 0:
+            sweeper.start()
+        wake_mail_sender()
+
     @app.before_request
     def define_session():
         g.service_name = 'DNS Forever beta'
         g.session = Session()
 
         g.user = get_user()
-        if g.user:
-            g.domain_list = [ownership.domain.name
-                             for ownership in g.user.ownership]
-        else:
-            g.domain_list = []
+        g.session.use_replica = request.method == 'GET' and \
+            request.endpoint in replica_endpoints
+        # The navigation menu lists one page of domains; the dashboard
+        # pages through the rest.
+        domain_names = get_domain_names(page_size + 1)
+        g.domain_list = domain_names[:page_size]
+        g.domain_list_more = len(domain_names) > page_size
 
         g.debug = app.debug
 
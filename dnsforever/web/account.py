@@ -3,7 +3,7 @@ from wtforms import Form, TextField, PasswordField, validators, ValidationError
 
 from dnsforever.models import User, EmailValidation, FindPasswd
 from dnsforever.web.tools.session import login, set_user, get_user
-from dnsforever.web.tools import password_hash
+from dnsforever.web.tools import password_hash, check_password
 from dnsforever.web import email
 
 app = Blueprint('account', __name__, url_prefix='/account')
@@ -53,7 +53,12 @@ class SigninForm(Form):
 
     def validate_email(form, field):
         user = g.session.query(User).filter(User.email == field.data).first()
-        if user is None or user.password != password_hash(form.password.data):
+        if user is None:
+            raise ValidationError('Email or Password is wrong.')
+
+        valid, form.needs_rehash = check_password(form.password.data,
+                                                  user.password)
+        if not valid:
             raise ValidationError('Email or Password is wrong.')
 
 
@@ -72,6 +77,12 @@ def signin_process():
         return render_template('signin.html', form=form)
 
     user = g.session.query(User).filter(User.email == form.email.data).first()
+
+    if form.needs_rehash:
+        user.password = password_hash(form.password.data)
+        with g.session.begin():
+            g.session.add(user)
+
     if user.type == 2:
         email.email_validation(user)
         return redirect(url_for('account.need_email_validation'))
@@ -106,7 +117,7 @@ def resetpasswd():
 
     user = get_user()
 
-    if password_hash(form.old_password.data) != user.password:
+    if not check_password(form.old_password.data, user.password)[0]:
         form.old_password.errors.append('Please enter the correct password.')
         return render_template('resetpasswd.html', form=form)
 
@@ -130,9 +141,7 @@ def need_email_validation_resend():
 
 @app.route('/validation/<string:token>', methods=['GET'])
 def validation(token):
-    ev = g.session.query(EmailValidation)\
-                  .filter(EmailValidation.token.like(token))\
-                  .first()
+    ev = EmailValidation.find_token(g.session, token)
 
     if not ev:
         return redirect(url_for('index.index'))
@@ -184,9 +193,7 @@ class FindPasswdResetPWForm(Form):
 
 @app.route('/findpasswd/<string:token>', methods=['GET'])
 def findpasswd_resetpasswd(token):
-    fp = g.session.query(FindPasswd)\
-                  .filter(FindPasswd.token == token)\
-                  .first()
+    fp = FindPasswd.find_token(g.session, token)
     if not fp:
         return render_template('findpasswd_wrongtoken.html')
 
@@ -196,9 +203,7 @@ def findpasswd_resetpasswd(token):
 
 @app.route('/findpasswd/<string:token>', methods=['POST'])
 def findpasswd_resetpasswd_process(token):
-    fp = g.session.query(FindPasswd)\
-                  .filter(FindPasswd.token == token)\
-                  .first()
+    fp = FindPasswd.find_token(g.session, token)
     if not fp:
         return render_template('findpasswd_wrongtoken.html')
 
@@ -1,16 +1,40 @@
-import string
 import re
+import json
+import time
+import socket
 from datetime import datetime, tzinfo, timedelta
+from functools import wraps
 
-from flask import Blueprint, g, request
+from flask import Blueprint, Response, g, request, stream_with_context
 from flask.ext import restful
 from flask.ext.restful import reqparse
-
-from dnsforever.models import Domain, Record, RecordDDNS_A, NameServer
+from sqlalchemy import func
+
+from dnsforever.config import ddns_flush_interval, page_size, \
+    server_wait_timeout
+from dnsforever.ddns import DdnsBuffer, apply_ddns_updates, \
+    find_ddns_records
+from dnsforever.models import NameServer, RecordChange, Domain, \
+    DomainOwnership, Record, ApiToken
+from dnsforever.zone import export_zones, export_cached_zones
+from dnsforever.zonecache import create_zone_cache
+from dnsforever.notify import wait_for_change
+from dnsforever.registration import STATUS_OK, register_domains
+from dnsforever.web.tools.pagination import paginate, page_limit
+from dnsforever.web.tools.records import RecordError, record_dict, \
+    query_records, apply_record_operations
+from dnsforever.web.tools.session import get_user
 
 app = Blueprint('apis', __name__, url_prefix='/apis')
 api = restful.Api(app)
 
+zone_cache = create_zone_cache()
+
+if ddns_flush_interval > 0:
+    ddns_buffer = DdnsBuffer(ddns_flush_interval)
+else:
+    ddns_buffer = None
+
 
 class UTC(tzinfo):
     def utcoffset(self, dt):
@@ -32,47 +56,406 @@ def todatetime(ts, epoch=datetime(1970, 1, 1)):
     return datetime.fromtimestamp(ts, UTC())
 
 
+def is_nameserver():
+    ns = g.session.query(NameServer)\
+                  .filter(NameServer.ip == request.remote_addr).first()
+    return bool(ns) or g.debug
+
+
+def stream_zones(session, last_update):
+    for name, serial, updated_at, records in \
+            export_zones(session, last_update, stream=True):
+        yield json.dumps({'domain': name,
+                          'records': records,
+                          'last_update': totimestamp(updated_at)}) + '\n'
+
+
+def change_sequence():
+    return g.session.query(func.max(RecordChange.id)).scalar() or 0
+
+
 class ServerUpdate(restful.Resource):
     def get(self):
         parser = reqparse.RequestParser()
         parser.add_argument('last_update', type=int, default=None)
+        parser.add_argument('stream', type=int, default=0)
         args = parser.parse_args()
 
-        ns = g.session.query(NameServer)\
-                      .filter(NameServer.ip == request.remote_addr).first()
-
-        if not ns and not g.debug:
+        if not is_nameserver():
             return 'ERROR', 403
 
-        update_query = g.session.query(Domain)
+        etag = str(change_sequence())
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={'ETag': '"%s"' % etag})
+
         if args.last_update:
             last_update = todatetime(args.last_update)
-            update_query = update_query.filter(Domain.updated_at > last_update)
-        domains = update_query.all()
+        else:
+            last_update = None
+
+        if args.stream:
+            zones = stream_zones(g.session, last_update)
+            return Response(stream_with_context(zones),
+                            mimetype='application/x-ndjson',
+                            headers={'ETag': '"%s"' % etag})
+
+        if zone_cache is not None:
+            zones = export_cached_zones(g.session, zone_cache, last_update)
+        else:
+            zones = export_zones(g.session, last_update)
 
         result = {}
-        for domain in domains:
-            records = g.session.query(Record)\
-                               .filter(Record.domain == domain)\
-                               .all()
+        for name, serial, updated_at, records in zones:
+            result[name] = {'records': records,
+                            'last_update': totimestamp(updated_at)}
 
-            records = [string.join([record.name or '@',
-                                    record.type, record.rdata], ' ')
-                       for record in records]
+        return result, 200, {'ETag': '"%s"' % etag}
 
-            soa_record = '@ SOA ns1.dnsforever.kr. root.%s. '\
-                         '%d 3600 600 86400 3600' %\
-                         (domain.name, domain.update_serial)
-            records.insert(0, soa_record)
+api.add_resource(ServerUpdate, '/server/update')
 
-            domain_info = {'records': records,
-                           'last_update': totimestamp(domain.updated_at)}
 
-            result[domain.name] = domain_info
+class ServerChanges(restful.Resource):
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('since', type=int, default=0)
+        parser.add_argument('limit', type=int, default=1000)
+        args = parser.parse_args()
 
-        return result
+        if not is_nameserver():
+            return 'ERROR', 403
 
-api.add_resource(ServerUpdate, '/server/update')
+        # Changes after `since` may have been swept already; the
+        # nameserver then starts over from a full copy of every zone.
+        oldest = g.session.query(func.min(RecordChange.id)).scalar()
+        if oldest is not None and args.since < oldest - 1:
+            last_seq = change_sequence()
+            if zone_cache is not None:
+                zones = export_cached_zones(g.session, zone_cache)
+            else:
+                zones = export_zones(g.session)
+            return {'last_seq': last_seq,
+                    'full': True,
+                    'zones': dict((name, records)
+                                  for name, _, _, records in zones)}
+
+        changes = g.session.query(RecordChange)\
+                           .filter(RecordChange.id > args.since)\
+                           .order_by(RecordChange.id)\
+                           .limit(max(args.limit, 0))\
+                           .all()
+
+        if changes:
+            last_seq = changes[-1].id
+        else:
+            last_seq = max(change_sequence(), args.since)
+
+        return {'last_seq': last_seq,
+                'full': False,
+                'changes': [{'seq': change.id,
+                             'domain': change.domain_name,
+                             'serial': change.serial,
+                             'action': change.action,
+                             'old': change.old,
+                             'new': change.new}
+                            for change in changes]}
+
+api.add_resource(ServerChanges, '/server/changes')
+
+
+class ServerWait(restful.Resource):
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('since', type=int, required=True)
+        parser.add_argument('timeout', type=int,
+                            default=server_wait_timeout)
+        args = parser.parse_args()
+
+        if not is_nameserver():
+            return 'ERROR', 403
+
+        # Each waiting nameserver holds a web worker, and the wakeup only
+        # reaches waiters in this process, so waits are kept short.
+        deadline = time.time() + min(max(args.timeout, 0),
+                                     server_wait_timeout)
+        while True:
+            last_seq = change_sequence()
+            remaining = deadline - time.time()
+            if last_seq > args.since or remaining <= 0:
+                break
+            wait_for_change(min(remaining, 1))
+
+        return {'last_seq': last_seq, 'changed': last_seq > args.since}
+
+api.add_resource(ServerWait, '/server/wait')
+
+
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+def authenticate(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        user = None
+        auth = request.headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            token = ApiToken.find_token(g.session, auth[7:].strip())
+            if token:
+                user = token.user
+        elif request.method in SAFE_METHODS or \
+                request.mimetype == 'application/json':
+            # A cross-site form can ride on the login cookie but cannot
+            # send a JSON body without a CORS preflight, which is never
+            # answered here.
+            user = get_user()
+
+        if user is None:
+            return 'ERROR', 401
+        g.api_user = user
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def api_domain(name):
+    return g.session.query(Domain)\
+                    .join(DomainOwnership.domain)\
+                    .filter(DomainOwnership.user_id == g.api_user.id)\
+                    .filter(Domain.name == name.lower())\
+                    .first()
+
+
+def api_record(domain, record_id):
+    return query_records(g.session, domain)\
+        .filter(Record.id == record_id).first()
+
+
+def page_arguments():
+    parser = reqparse.RequestParser()
+    parser.add_argument('after', type=str, default=None)
+    parser.add_argument('limit', type=int, default=page_size)
+    return parser.parse_args()
+
+
+def record_operations(domain, operations):
+    try:
+        return apply_record_operations(g.session, domain, operations), None
+    except RecordError as e:
+        return None, ({'errors': e.errors}, 400)
+
+
+class DomainList(restful.Resource):
+    method_decorators = [authenticate]
+
+    def get(self):
+        args = page_arguments()
+        query = g.session.query(Domain, DomainOwnership.master)\
+                         .join(DomainOwnership.domain)\
+                         .filter(DomainOwnership.user_id == g.api_user.id)
+        page = paginate(query, Domain.name, Domain.id,
+                        args.after, page_limit(args.limit),
+                        key=lambda row: (row.Domain.name, row.Domain.id))
+
+        return {'domains': [{'name': domain.name,
+                             'serial': domain.update_serial,
+                             'master': master}
+                            for domain, master in page],
+                'next': page.next_cursor}
+
+    def post(self):
+        data = request.get_json(silent=True) or {}
+        domains = data.get('domains')
+        if domains is None:
+            domains = request.form.get('domains', '').split()
+        if not isinstance(domains, list):
+            return 'ERROR', 400
+
+        results = register_domains(g.session, g.api_user, domains)
+        code = 200
+        if any(status != STATUS_OK for _, status in results):
+            code = 207 if any(status == STATUS_OK
+                              for _, status in results) else 400
+
+        return {'results': [{'domain': domain, 'status': status}
+                            for domain, status in results]}, code
+
+api.add_resource(DomainList, '/domains')
+
+
+class DomainDetail(restful.Resource):
+    method_decorators = [authenticate]
+
+    def get(self, domain):
+        domain = api_domain(domain)
+        if not domain:
+            return 'ERROR', 404
+
+        return {'name': domain.name,
+                'serial': domain.update_serial,
+                'last_update': totimestamp(domain.updated_at)}
+
+api.add_resource(DomainDetail, '/domains/<string:domain>')
+
+
+class RecordList(restful.Resource):
+    method_decorators = [authenticate]
+
+    def get(self, domain):
+        domain = api_domain(domain)
+        if not domain:
+            return 'ERROR', 404
+
+        args = page_arguments()
+        page = paginate(query_records(g.session, domain),
+                        Record.name, Record.id,
+                        args.after, page_limit(args.limit))
+        return {'records': [record_dict(record) for record in page],
+                'next': page.next_cursor}
+
+    def post(self, domain):
+        domain = api_domain(domain)
+        data = request.get_json(silent=True)
+        if not domain:
+            return 'ERROR', 404
+        if not isinstance(data, dict):
+            return 'ERROR', 400
+
+        data = dict(data, op='create')
+        results, error = record_operations(domain, [data])
+        if error:
+            return error
+        return results[0], 201
+
+api.add_resource(RecordList, '/domains/<string:domain>/records')
+
+
+class RecordDetail(restful.Resource):
+    method_decorators = [authenticate]
+
+    def get(self, domain, record_id):
+        domain = api_domain(domain)
+        if not domain:
+            return 'ERROR', 404
+
+        record = api_record(domain, record_id)
+        if not record:
+            return 'ERROR', 404
+        return record_dict(record)
+
+    def put(self, domain, record_id):
+        domain = api_domain(domain)
+        data = request.get_json(silent=True)
+        if not domain:
+            return 'ERROR', 404
+        if not isinstance(data, dict):
+            return 'ERROR', 400
+
+        data = dict(data, op='update', id=record_id)
+        results, error = record_operations(domain, [data])
+        if error:
+            return error
+        return results[0]
+
+    def delete(self, domain, record_id):
+        domain = api_domain(domain)
+        if not domain:
+            return 'ERROR', 404
+
+        results, error = record_operations(domain, [{'op': 'delete',
+                                                     'id': record_id}])
+        if error:
+            return 'ERROR', 404
+        return results[0]
+
+api.add_resource(RecordDetail,
+                 '/domains/<string:domain>/records/<int:record_id>')
+
+
+class RecordBatch(restful.Resource):
+    method_decorators = [authenticate]
+
+    def post(self, domain):
+        domain = api_domain(domain)
+        data = request.get_json(silent=True) or {}
+        if not domain:
+            return 'ERROR', 404
+
+        operations = data.get('operations')
+        if not isinstance(operations, list):
+            return 'ERROR', 400
+
+        results, error = record_operations(domain, operations)
+        if error:
+            return error
+        return {'serial': domain.update_serial, 'results': results}
+
+api.add_resource(RecordBatch, '/domains/<string:domain>/records/batch')
+
+
+class TokenList(restful.Resource):
+    method_decorators = [authenticate]
+
+    def get(self):
+        tokens = g.session.query(ApiToken)\
+                          .filter(ApiToken.user_id == g.api_user.id)\
+                          .order_by(ApiToken.id)
+        return {'tokens': [{'id': token.id,
+                            'name': token.name,
+                            'expires_at': totimestamp(token.expires_at)}
+                           for token in tokens]}
+
+    def post(self):
+        data = request.get_json(silent=True) or {}
+        name = data.get('name') or request.form.get('name')
+        if not isinstance(name, basestring) or not 0 < len(name) <= 100:
+            return 'ERROR', 400
+
+        token = ApiToken(g.api_user, name)
+        with g.session.begin():
+            g.session.add(token)
+
+        # The plain token is only available in this response.
+        return {'id': token.id,
+                'name': token.name,
+                'token': token.token,
+                'expires_at': totimestamp(token.expires_at)}, 201
+
+api.add_resource(TokenList, '/tokens')
+
+
+class TokenDetail(restful.Resource):
+    method_decorators = [authenticate]
+
+    def delete(self, token_id):
+        with g.session.begin():
+            deleted = g.session.query(ApiToken)\
+                               .filter(ApiToken.id == token_id)\
+                               .filter(ApiToken.user_id == g.api_user.id)\
+                               .delete()
+        if not deleted:
+            return 'ERROR', 404
+        return 'OK'
+
+api.add_resource(TokenDetail, '/tokens/<int:token_id>')
+
+
+IPV4_PATTERN = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
+
+
+def is_address(family, ip):
+    try:
+        socket.inet_pton(family, ip)
+    except (socket.error, ValueError):
+        return False
+    return True
+
+
+def ddns_record_type(ip):
+    if not ip:
+        return None
+    if IPV4_PATTERN.match(ip) and is_address(socket.AF_INET, ip):
+        return 'A'
+    if is_address(socket.AF_INET6, ip):
+        return 'AAAA'
+    return None
 
 
 class DdnsUpdate(restful.Resource):
@@ -81,34 +464,51 @@ class DdnsUpdate(restful.Resource):
         parser.add_argument('key', type=str, required=True)
         parser.add_argument('host', type=str, required=True)
         parser.add_argument('ip', type=str)
+        parser.add_argument('ip6', type=str)
         args = parser.parse_args()
 
-        record = g.session.query(RecordDDNS_A)\
-                          .filter(RecordDDNS_A.ddns_key == args['key'])\
-                          .first()
+        records = find_ddns_records(g.session, args['key'])
 
-        if not record:
+        if not records:
             return 'ERROR', 404
 
-        if record.name:
-            host = '%s.%s' % (record.name, record.domain.name)
+        _, name, _, _, domain_name = records[0]
+
+        if name:
+            host = '%s.%s' % (name, domain_name)
         else:
-            host = record.domain.name
+            host = domain_name
 
         if host != args['host']:
             return 'ERROR', 404
 
-        if 'ip' in args and args['ip']:
-            record.ip = args['ip']
-        else:
-            record.ip = request.remote_addr
-
-        if not re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$', record.ip):
+        addresses = [ip for ip in (args['ip'], args['ip6']) if ip]
+        if not addresses:
+            addresses = [request.remote_addr]
+
+        ips = {}
+        for ip in addresses:
+            type = ddns_record_type(ip)
+            if type is None:
+                return 'ERROR', 404
+            ips[type] = ip
+
+        updates = {}
+        for record_id, _, type, current_ip, _ in records:
+            if type not in ips:
+                continue
+            if ddns_buffer is not None:
+                current_ip = ddns_buffer.get(record_id) or current_ip
+            if ips[type] != current_ip:
+                updates[record_id] = ips[type]
+
+        if not any(type in ips for _, _, type, _, _ in records):
             return 'ERROR', 404
 
-        with g.session.begin():
-            record.update()
-            g.session.add(record)
+        if ddns_buffer is None:
+            apply_ddns_updates(g.session, updates)
+        elif updates:
+            ddns_buffer.put(updates)
 
         return 'OK'
 
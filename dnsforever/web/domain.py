@@ -1,13 +1,13 @@
-from flask import Blueprint, g, render_template, request, url_for, redirect
+from flask import Blueprint, Response, g, render_template, request, url_for, \
+    redirect, stream_with_context
 
-from dnsforever.domain import ROOT_DOMAIN
-from dnsforever.web.tools.session import login, get_user, get_domain
+from dnsforever.web.tools.pagination import paginate
+from dnsforever.web.tools.session import login, get_user, get_domain, \
+    ownership_query
 from dnsforever.models import Domain, DomainOwnership, NameServer, \
     SubdomainSharing
-import re
-import string
-
-DOMAIN_PATTERN = re.compile('^([a-z0-9\-]+\.)+([a-z0-9\-]+)$')
+from dnsforever.registration import STATUS_OK, register_domains
+from dnsforever.zonefile import ZoneFileError, import_zone, zone_file
 
 app = Blueprint('domain', __name__, url_prefix='/domain')
 
@@ -15,27 +15,25 @@ app = Blueprint('domain', __name__, url_prefix='/domain')
 @app.route('/')
 @login(True, '/')
 def index():
-    tickets = g.session.query(SubdomainSharing)\
-                       .filter(SubdomainSharing.email.like(get_user().email))\
-                       .all()
+    tickets = SubdomainSharing.for_email(g.session, get_user().email).all()
     ns_list = g.session.query(NameServer).all()
+    ownerships = paginate(ownership_query(), Domain.name, Domain.id,
+                          request.args.get('after'),
+                          key=lambda row: (row.Domain.name, row.Domain.id))
     return render_template('dashboard.html',
                            ns_list=ns_list,
-                           ownership_list=g.user.ownership,
+                           ownership_list=ownerships,
                            subdomain_tickets=tickets)
 
 
-@app.route('/subdomain/<string:token>', methods=['GET'])
+@app.route('/subdomain/<int:ticket_id>', methods=['GET'])
 @login(True, '/')
-def subdomain_add(token):
-    ticket = g.session.query(SubdomainSharing)\
-                      .filter(SubdomainSharing.token.like(token)).first()
+def subdomain_add(ticket_id):
+    ticket = SubdomainSharing.for_email(g.session, get_user().email)\
+                             .filter(SubdomainSharing.id == ticket_id).first()
     if not ticket:
         return redirect(url_for('domain.index'))
 
-    if ticket.email and ticket.email != get_user().email:
-        return redirect(url_for('domain.index'))
-
     subdomain_name = '%s.%s' % (ticket.name, ticket.domain.name)
     domain = Domain(name=subdomain_name, parent_id=ticket.domain.id)
     ownership = DomainOwnership(master=False, user=get_user(), domain=domain)
@@ -47,17 +45,14 @@ def subdomain_add(token):
     return redirect(url_for('domain.index'))
 
 
-@app.route('/subdomain/<string:token>/delete', methods=['GET'])
+@app.route('/subdomain/<int:ticket_id>/delete', methods=['GET'])
 @login(True, '/')
-def subdomain_delete(token):
-    ticket = g.session.query(SubdomainSharing)\
-                      .filter(SubdomainSharing.token.like(token)).first()
+def subdomain_delete(ticket_id):
+    ticket = SubdomainSharing.for_email(g.session, get_user().email)\
+                             .filter(SubdomainSharing.id == ticket_id).first()
     if not ticket:
         return redirect(url_for('domain.index'))
 
-    if ticket.email and ticket.email != get_user().email:
-        return redirect(url_for('domain.index'))
-
     with g.session.begin():
         g.session.delete(ticket)
 
@@ -70,58 +65,20 @@ def new():
     return render_template('domain_new.html')
 
 
-def check_domain_owner(domain):
-    if domain in ROOT_DOMAIN:
-        return False
-    domain = domain.split('.')
-    for i in range(len(domain)):
-        sub_domain = domain[i - len(domain):]
-        sub_domain = string.join(sub_domain, '.')
-        if g.session.query(Domain)\
-                    .filter(Domain.name == sub_domain).count() > 0:
-            return False
-    return True
-
-
 @app.route('/new', methods=['POST'])
 @login(True, '/')
 def new_process():
-    if 'domain' in request.form:
-        domains = request.form['domain'].split()
-    else:
-        domains = []
-
-    error_domains = []
-    for domain in domains:
-        try:
-            domain = str(domain)
-        except:
-            error_domains.append(domain)
-            continue
-
-        if not DOMAIN_PATTERN.match(domain.lower()):
-            error_domains.append(domain)
-            continue
-
-        if check_domain_owner(domain) is False:
-            error_domains.append(domain)
-            continue
-
-        try:
-            with g.session.begin():
-                domain = Domain(name=domain.lower())
-                ownership = DomainOwnership(master=True,
-                                            user=get_user(),
-                                            domain=domain)
-                g.session.add(ownership)
-        except:
-            error_domains.append(domain)
-            continue
-
-    if len(error_domains) > 0:
+    domains = request.form.get('domain', '').split()
+    results = register_domains(g.session, get_user(), domains)
+
+    failed = [(domain, status) for domain, status in results
+              if status != STATUS_OK]
+    if failed:
+        registered = [domain for domain, status in results
+                      if status == STATUS_OK]
         return render_template('domain_new.html',
-                               error_domains=error_domains,
-                               domains=domains)
+                               registered=registered,
+                               failed=failed)
 
     return redirect(url_for('domain.index'))
 
@@ -137,6 +94,54 @@ def detail(domain):
     return render_template('domain_detail.html', domain=domain)
 
 
+@app.route('/<string:domain>/zone', methods=['GET'])
+@login(True, '/')
+def zone_export(domain):
+    domain = get_domain(domain)
+
+    if not domain:
+        return redirect(url_for('domain.index'))
+
+    return Response(stream_with_context(zone_file(g.session, domain)),
+                    mimetype='text/plain',
+                    headers={'Content-Disposition':
+                             'attachment; filename=%s.zone' % domain.name})
+
+
+@app.route('/<string:domain>/zone/import', methods=['GET'])
+@login(True, '/')
+def zone_import(domain):
+    domain = get_domain(domain)
+
+    if not domain:
+        return redirect(url_for('domain.index'))
+
+    return render_template('domain_zone_import.html', domain=domain)
+
+
+@app.route('/<string:domain>/zone/import', methods=['POST'])
+@login(True, '/')
+def zone_import_process(domain):
+    domain = get_domain(domain)
+
+    if not domain:
+        return redirect(url_for('domain.index'))
+
+    zonefile = request.files.get('zonefile')
+    if not zonefile:
+        return render_template('domain_zone_import.html', domain=domain,
+                               errors=[(0, 'No zone file uploaded.')])
+
+    try:
+        added, skipped = import_zone(g.session, domain, zonefile.stream)
+    except ZoneFileError as e:
+        return render_template('domain_zone_import.html', domain=domain,
+                               errors=e.errors)
+
+    return render_template('domain_zone_import.html', domain=domain,
+                           added=added, skipped=skipped)
+
+
 @app.route('/<string:domain>/del', methods=['GET'])
 @login(True, '/')
 def domain_delete(domain):
@@ -1,6 +1,7 @@
 from flask import Blueprint, g, render_template, request, url_for, redirect
 from wtforms import Form, StringField, BooleanField, validators
 from dnsforever.web.tools import random_string
+from dnsforever.web.tools.pagination import paginate
 from dnsforever.web.tools.session import login, get_user, get_domain
 from dnsforever.models import Domain, RecordA
 
@@ -15,10 +16,11 @@ def record_list(domain):
     if not domain:
         return redirect(url_for('domain.index'))
 
-    records = g.session.query(RecordA).filter(RecordA.domain == domain)\
-                                      .order_by(RecordA.name).all()
+    query = g.session.query(RecordA).filter(RecordA.domain == domain)
+    records = paginate(query, RecordA.name, RecordA.id,
+                       request.args.get('after'))
 
-    if not records:
+    if not records and not request.args.get('after'):
         return redirect(url_for('domain_a.record_new', domain=domain.name))
 
     return render_template('domain_a/list.html',
@@ -1,5 +1,6 @@
 from flask import Blueprint, g, render_template, request, url_for, redirect
 from wtforms import Form, TextField, validators
+from dnsforever.web.tools.pagination import paginate
 from dnsforever.web.tools.session import login, get_user, get_domain
 from dnsforever.models import Domain, RecordAAAA
 
@@ -16,10 +17,11 @@ def record_list(domain):
     if not domain:
         return redirect(url_for('domain.index'))
 
-    records = g.session.query(RecordAAAA).filter(RecordAAAA.domain == domain)\
-                                         .order_by(RecordAAAA.name).all()
+    query = g.session.query(RecordAAAA).filter(RecordAAAA.domain == domain)
+    records = paginate(query, RecordAAAA.name, RecordAAAA.id,
+                       request.args.get('after'))
 
-    if not records:
+    if not records and not request.args.get('after'):
         return redirect(url_for('domain_aaaa.record_new', domain=domain.name))
 
     return render_template('domain_aaaa/list.html',
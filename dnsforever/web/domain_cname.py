@@ -1,6 +1,7 @@
 from flask import Blueprint, g, render_template, request, url_for, redirect
 from wtforms import Form, TextField
 from wtforms.validators import Length, Regexp
+from dnsforever.web.tools.pagination import paginate
 from dnsforever.web.tools.session import login, get_user, get_domain
 from dnsforever.models import Domain, RecordCNAME
 
@@ -17,11 +18,11 @@ def record_list(domain):
     if not domain:
         return redirect(url_for('domain.index'))
 
-    records = g.session.query(RecordCNAME)\
-                       .filter(RecordCNAME.domain == domain)\
-                       .order_by(RecordCNAME.name).all()
+    query = g.session.query(RecordCNAME).filter(RecordCNAME.domain == domain)
+    records = paginate(query, RecordCNAME.name, RecordCNAME.id,
+                       request.args.get('after'))
 
-    if not records:
+    if not records and not request.args.get('after'):
         return redirect(url_for('domain_cname.record_new', domain=domain.name))
 
     return render_template('domain_cname/list.html',
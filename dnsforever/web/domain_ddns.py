@@ -1,7 +1,8 @@
 from flask import Blueprint, g, render_template, request, url_for, redirect
 from wtforms import Form, StringField, validators
+from dnsforever.web.tools.pagination import paginate
 from dnsforever.web.tools.session import login, get_domain
-from dnsforever.models import RecordDDNS_A
+from dnsforever.models import RecordDDNS_A, RecordDDNS_AAAA
 
 app = Blueprint('domain_ddns',
                 __name__,
@@ -16,16 +17,27 @@ def record_list(domain):
     if not domain:
         return redirect(url_for('domain.index'))
 
-    records = g.session.query(RecordDDNS_A)\
-                       .filter(RecordDDNS_A.domain == domain)\
-                       .order_by(RecordDDNS_A.name).all()
+    query = g.session.query(RecordDDNS_A)\
+                     .filter(RecordDDNS_A.domain == domain)
+    records = paginate(query, RecordDDNS_A.name, RecordDDNS_A.id,
+                       request.args.get('after'))
 
-    if not records:
+    if not records and not request.args.get('after'):
         return redirect(url_for('domain_ddns.record_new', domain=domain.name))
 
+    ip6_records = {}
+    ddns_keys = [record.ddns_key for record in records]
+    if ddns_keys:
+        ip6_records = g.session.query(RecordDDNS_AAAA)\
+                               .filter(RecordDDNS_AAAA.domain == domain)\
+                               .filter(RecordDDNS_AAAA.ddns_key.in_(ddns_keys))
+        ip6_records = dict((record.ddns_key, record)
+                           for record in ip6_records)
+
     return render_template('domain_ddns/list.html',
                            domain=domain,
-                           records=records)
+                           records=records,
+                           ip6_records=ip6_records)
 
 
 class RecordDDNSForm(Form):
@@ -34,9 +46,18 @@ class RecordDDNSForm(Form):
                                           '(^([a-z0-9\-]+\.)*'
                                           '([a-z0-9\-]+)$)')])
     ip = StringField('ip', [validators.IPAddress()])
+    ip6 = StringField('ip6', [validators.Optional(),
+                              validators.IPAddress(ipv4=False, ipv6=True)])
     memo = StringField('memo', [validators.Length(max=1000)])
 
 
+def ip6_record(record):
+    return g.session.query(RecordDDNS_AAAA)\
+                    .filter(RecordDDNS_AAAA.domain_id == record.domain_id)\
+                    .filter(RecordDDNS_AAAA.ddns_key == record.ddns_key)\
+                    .first()
+
+
 @app.route('/new', methods=['GET'])
 @login(True, '/')
 def record_new(domain):
@@ -67,7 +88,9 @@ def record_edit(domain, record_id):
     if not record:
         return redirect(url_for('domain_ddns.record_list', domain=domain.name))
 
-    form = RecordDDNSForm(name=record.name, ip=record.ip, memo=record.memo)
+    record6 = ip6_record(record)
+    form = RecordDDNSForm(name=record.name, ip=record.ip,
+                          ip6=record6 and record6.ip, memo=record.memo)
 
     return render_template('domain_ddns/edit.html',
                            domain=domain,
@@ -96,6 +119,12 @@ def record_new_process(domain):
         with g.session.begin():
             ddns_record.update()
             g.session.add(ddns_record)
+            if form.ip6.data:
+                g.session.add(RecordDDNS_AAAA(domain=domain,
+                                              name=ddns_record.name,
+                                              ip=form.ip6.data,
+                                              memo=form.memo.data,
+                                              ddns_key=ddns_record.ddns_key))
     except ValueError as e:
         form.name.errors.append(e)
         return render_template('domain_ddns/new.html',
@@ -128,12 +157,24 @@ def record_edit_process(domain, record_id):
                                domain=domain,
                                form=form)
 
-    record.ip = form.ip.data
-    record.memo = form.memo.data
+    record6 = ip6_record(record)
 
     with g.session.begin():
+        record.ip = form.ip.data
+        record.memo = form.memo.data
         record.domain.update()
         g.session.add(record)
+        if form.ip6.data and record6:
+            record6.ip = form.ip6.data
+            record6.memo = form.memo.data
+        elif form.ip6.data:
+            g.session.add(RecordDDNS_AAAA(domain=domain,
+                                          name=record.name,
+                                          ip=form.ip6.data,
+                                          memo=form.memo.data,
+                                          ddns_key=record.ddns_key))
+        elif record6:
+            g.session.delete(record6)
 
     return redirect(url_for('domain_ddns.record_list', domain=domain.name))
 
@@ -154,10 +195,13 @@ def record_delete(domain, record_id):
         return redirect(url_for('domain_ddns.record_list', domain=domain.name))
 
     if request.method == 'POST':
+        record6 = ip6_record(record)
         with g.session.begin():
             record.domain.update()
             g.session.add(record.domain)
             g.session.delete(record)
+            if record6:
+                g.session.delete(record6)
         return redirect(url_for('domain_ddns.record_list', domain=domain.name))
 
     return render_template('domain_ddns/del.html',
@@ -1,6 +1,7 @@
 from flask import Blueprint, g, render_template, request, url_for, redirect
 from wtforms import Form, TextField, IntegerField
 from wtforms.validators import Regexp, NumberRange
+from dnsforever.web.tools.pagination import paginate
 from dnsforever.web.tools.session import login, get_user, get_domain
 from dnsforever.models import Domain, RecordMX
 
@@ -17,12 +18,11 @@ def record_list(domain):
     if not domain:
         return redirect(url_for('domain.index'))
 
-    records = g.session.query(RecordMX).filter(RecordMX.domain == domain)\
-                                       .all()
+    query = g.session.query(RecordMX).filter(RecordMX.domain == domain)
+    records = paginate(query, RecordMX.name, RecordMX.id,
+                       request.args.get('after'))
 
-    records = sorted(records, key=lambda record: record.preference)
-
-    if not records:
+    if not records and not request.args.get('after'):
         return redirect(url_for('domain_mx.record_new', domain=domain.name))
 
     return render_template('domain_mx/list.html',
@@ -1,5 +1,6 @@
 from flask import Blueprint, g, render_template, request, url_for, redirect
 from wtforms import Form, StringField, validators
+from dnsforever.web.tools.pagination import paginate
 from dnsforever.web.tools.session import login, get_domain, get_user
 from dnsforever.models import Domain, SubdomainSharing
 
@@ -15,17 +16,13 @@ def subdomain_info(domain):
     if not domain:
         return redirect(url_for('domain.index'))
 
-    tickets = g.session.query(SubdomainSharing)\
-                       .filter(SubdomainSharing.domain == domain)\
-                       .all()
-
-    subdomains = g.session.query(Domain)\
-                          .filter(Domain.parent_id == domain.id)\
-                          .all()
+    query = g.session.query(SubdomainSharing)\
+                     .filter(SubdomainSharing.domain == domain)
+    tickets = paginate(query, SubdomainSharing.name, SubdomainSharing.id,
+                       request.args.get('after'))
 
     return render_template('domain_subdomain/info.html',
                            domain=domain,
-                           subdomains=subdomains,
                            tickets=tickets)
 
 
@@ -3,6 +3,7 @@ import re
 from flask import Blueprint, g, render_template, request, url_for, redirect
 from wtforms import Form, StringField
 from wtforms.validators import Regexp, Length, ValidationError
+from dnsforever.web.tools.pagination import paginate
 from dnsforever.web.tools.session import login, get_user, get_domain
 from dnsforever.models import Domain, RecordTXT
 
@@ -19,10 +20,11 @@ def record_list(domain):
     if not domain:
         return redirect(url_for('domain.index'))
 
-    records = g.session.query(RecordTXT).filter(RecordTXT.domain == domain)\
-                                        .order_by(RecordTXT.name).all()
+    query = g.session.query(RecordTXT).filter(RecordTXT.domain == domain)
+    records = paginate(query, RecordTXT.name, RecordTXT.id,
+                       request.args.get('after'))
 
-    if not records:
+    if not records and not request.args.get('after'):
         return redirect(url_for('domain_txt.record_new', domain=domain.name))
 
     return render_template('domain_txt/list.html',
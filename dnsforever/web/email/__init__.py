@@ -1,38 +1,60 @@
 # -*- coding: utf-8 -*-
 
 import os
-import smtplib
-from email.mime.text import MIMEText
-from email.header import Header
+import unittest
 
-from flask import g, url_for
-from jinja2 import Environment, FileSystemLoader
+from flask import g, url_for, current_app
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 from dnsforever.models import EmailValidation, FindPasswd
-from dnsforever.config import smtp_ssl, smtp_host, smtp_port, smtp_account
+from dnsforever.config import mail_sender_enabled, service_url, \
+    email_template_bytecode_cache
+from dnsforever.mailqueue import MailSender, enqueue_email
+
+
+def bytecode_cache(enabled=email_template_bytecode_cache):
+    if not enabled:
+        return None
+    # Without a directory Jinja creates and checks one only this user can
+    # write to; a shared path would let others plant bytecode.
+    return FileSystemBytecodeCache()
+
 
 email_env = Environment(loader=FileSystemLoader(os.path.dirname(__file__) +
-                                                '/templates'))
-email_env.globals = {'g': g, 'url_for': url_for}
+                                                '/templates'),
+                        bytecode_cache=bytecode_cache(),
+                        auto_reload=False,
+                        cache_size=-1)
+email_env.globals['url_for'] = url_for
 
 __all__ = ['email_validation']
 
 
-def send_text_email(to, subject, body):
-    msg = MIMEText(body, 'plain', 'utf-8')
-    msg['Subject'] = Header(subject, 'utf-8')
-    msg['From'] = 'noreply@dnsforever.kr'
-    msg['To'] = to
+def precompile_templates():
+    return [email_env.get_template(name)
+            for name in email_env.list_templates(extensions=['txt'])]
+
+precompile_templates()
+
+
+def render_emails(template_name, recipients, flask_app=None):
+    template = email_env.get_template(template_name)
+    # Build external links from service_url, not whatever request (if any)
+    # the batch happens to run in.
+    with (flask_app or current_app).test_request_context(base_url=service_url):
+        for to, context in recipients:
+            yield to, template.render(**context)
 
-    if not smtp_ssl:
-        s = smtplib.SMTP(smtp_host, smtp_port)
-    else:
-        s = smtplib.SMTP_SSL(smtp_host, smtp_port)
 
-    if smtp_account:
-        s.login(*smtp_account)
-    s.sendmail('noreply@dnsforever.kr', [to], msg.as_string())
-    s.quit()
+if mail_sender_enabled:
+    mail_sender = MailSender()
+else:
+    mail_sender = None
+
+
+def wake_mail_sender():
+    if mail_sender is not None:
+        mail_sender.wake()
 
 
 def email_validation(user):
@@ -44,19 +66,21 @@ def email_validation(user):
                    .filter(EmailValidation.user == user)\
                    .all()
 
+    template = email_env.get_template('email_validation.txt')
+    body = template.render(user=user,
+                           token=validation_email.token)
+
     with g.session.begin():
         for ev in evs:
             g.session.delete(ev)
 
         g.session.add(validation_email)
+        enqueue_email(g.session,
+                      to=user.email,
+                      subject=u'DNS Forever: 회원 가입확인',
+                      body=body)
 
-    template = email_env.get_template('email_validation.txt')
-    body = template.render(user=user,
-                           token=validation_email.token)
-
-    send_text_email(to=user.email,
-                    subject=u'DNS Forever: 회원 가입확인',
-                    body=body)
+    wake_mail_sender()
 
 
 def find_passwd(user):
@@ -65,15 +89,35 @@ def find_passwd(user):
                                .filter(FindPasswd.user == user)\
                                .all()
 
+    template = email_env.get_template('find_passwd.txt')
+    body = template.render(token=findpasswd_info.token)
+
     with g.session.begin():
         for fp in findpasswd_list:
             g.session.delete(fp)
 
         g.session.add(findpasswd_info)
-
-    template = email_env.get_template('find_passwd.txt')
-    body = template.render(token=findpasswd_info.token)
-
-    send_text_email(to=user.email,
-                    subject=u'DNS Forever: 비밀번호 초기화',
-                    body=body)
+        enqueue_email(g.session,
+                      to=user.email,
+                      subject=u'DNS Forever: 비밀번호 초기화',
+                      body=body)
+
+    wake_mail_sender()
+
+
+class RenderEmailsTestCase(unittest.TestCase):
+    def test_render_emails(self):
+        from dnsforever.web import create_app
+
+        self.assertIn('find_passwd.txt', [template.name for template
+                                          in precompile_templates()])
+        recipients = (('user%d@dnsforever.kr' % i, {'token': 'token%d' % i})
+                      for i in xrange(3))
+        emails = list(render_emails('find_passwd.txt', recipients,
+                                    create_app()))
+
+        self.assertEqual([to for to, _ in emails],
+                         ['user0@dnsforever.kr', 'user1@dnsforever.kr',
+                          'user2@dnsforever.kr'])
+        self.assertIn(service_url + '/account/findpasswd/token2',
+                      emails[2][1])
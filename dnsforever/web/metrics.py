@@ -0,0 +1,149 @@
+import time
+import unittest
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+
+from flask import Blueprint, Response, g, request, has_request_context
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from dnsforever.config import metrics_headers
+
+app = Blueprint('metrics', __name__)
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+METRICS = (('request_seconds', TIME_BUCKETS),
+           ('db_seconds', TIME_BUCKETS),
+           ('render_seconds', TIME_BUCKETS),
+           ('db_statements', COUNT_BUCKETS))
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.histograms = defaultdict(dict)
+
+    def observe(self, endpoint, values):
+        with self.lock:
+            histograms = self.histograms[endpoint]
+            for name, buckets in METRICS:
+                if name not in histograms:
+                    histograms[name] = Histogram(buckets)
+                histograms[name].observe(values[name])
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, _ in METRICS:
+                lines.append('# TYPE dnsforever_%s histogram' % name)
+                for endpoint in sorted(self.histograms):
+                    histogram = self.histograms[endpoint][name]
+                    for bound, count in histogram.cumulative():
+                        lines.append('dnsforever_%s_bucket{endpoint="%s",'
+                                     'le="%s"} %d' %
+                                     (name, endpoint, bound, count))
+                    lines.append('dnsforever_%s_sum{endpoint="%s"} %f' %
+                                 (name, endpoint, histogram.sum))
+                    lines.append('dnsforever_%s_count{endpoint="%s"} %d' %
+                                 (name, endpoint, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            if has_request_context() and hasattr(g, 'render_time'):
+                g.render_time += time.time() - start
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def statement_start(conn, cursor, statement, parameters, context,
+                    executemany):
+    conn.info['statement_start'] = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def statement_end(conn, cursor, statement, parameters, context,
+                  executemany):
+    if has_request_context() and hasattr(g, 'db_time'):
+        g.db_time += time.time() - conn.info['statement_start']
+        g.db_statements += 1
+
+
+def instrument(flask_app):
+    flask_app.jinja_env.template_class = TimedTemplate
+
+    @flask_app.before_request
+    def start_request():
+        g.request_start = time.time()
+        g.db_time = 0.0
+        g.db_statements = 0
+        g.render_time = 0.0
+
+    @flask_app.after_request
+    def finish_request(response):
+        if not hasattr(g, 'request_start'):
+            return response
+
+        values = {'request_seconds': time.time() - g.request_start,
+                  'db_seconds': g.db_time,
+                  'render_seconds': g.render_time,
+                  'db_statements': g.db_statements}
+        metrics.observe(request.endpoint or 'unknown', values)
+
+        if metrics_headers:
+            response.headers['X-DB-Statements'] = str(g.db_statements)
+            response.headers['X-DB-Time'] = '%.6f' % g.db_time
+            response.headers['X-Render-Time'] = '%.6f' % g.render_time
+            response.headers['X-Response-Time'] = \
+                '%.6f' % values['request_seconds']
+        return response
+
+
+@app.route('/metrics')
+def metrics_index():
+    if request.remote_addr not in ('127.0.0.1', '::1') and not g.debug:
+        return 'ERROR', 403
+    return Response(metrics.render(), mimetype='text/plain')
+
+
+class HistogramTestCase(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram((1, 5, 10))
+        for value in (0, 1, 3, 7, 100):
+            histogram.observe(value)
+
+        self.assertEqual(list(histogram.cumulative()),
+                         [(1, 2), (5, 3), (10, 4), ('+Inf', 5)])
+        self.assertEqual(histogram.sum, 111)
+        self.assertEqual(histogram.count, 5)
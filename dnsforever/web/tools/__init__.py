@@ -1,15 +1,72 @@
+import os
+import hmac
 import string
 import random
+import hashlib
+import unittest
 from hashlib import sha256
 
-from dnsforever.config import hash_salt
+from dnsforever.config import hash_salt, password_hash_iterations
+
+PASSWORD_HASH_PREFIX = 'pbkdf2'
 
 
 def random_string(size=40, chars=string.ascii_lowercase + string.digits):
     return ''.join(random.choice(chars) for _ in xrange(size))
 
 
-def password_hash(data):
+def legacy_password_hash(data):
     for i in xrange(9999):
         data = sha256(data + hash_salt).digest()
-    return sha256(data + hash_salt).hexdigest()
\ No newline at end of file
+    return sha256(data + hash_salt).hexdigest()
+
+
+def pbkdf2_hexdigest(data, salt, iterations):
+    # With OpenSSL, hashlib runs PBKDF2 without holding the GIL, so
+    # threaded workers hash in parallel without a process pool.
+    return hashlib.pbkdf2_hmac('sha256', data, salt, iterations).encode('hex')
+
+
+def password_hash(data, salt=None, iterations=password_hash_iterations):
+    if salt is None:
+        salt = os.urandom(8).encode('hex')
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+
+    digest = pbkdf2_hexdigest(data, salt, iterations)
+    return '%s$%d$%s$%s' % (PASSWORD_HASH_PREFIX, iterations, salt, digest)
+
+
+def check_password(data, hashed):
+    if not hashed:
+        return False, False
+
+    if not hashed.startswith(PASSWORD_HASH_PREFIX + '$'):
+        valid = hmac.compare_digest(str(legacy_password_hash(data)),
+                                    str(hashed))
+        return valid, valid
+
+    _, iterations, salt, _ = hashed.split('$')
+    valid = hmac.compare_digest(password_hash(data, str(salt),
+                                              int(iterations)),
+                                str(hashed))
+    return valid, valid and int(iterations) != password_hash_iterations
+
+
+class PasswordHashTestCase(unittest.TestCase):
+    def test_password_hash(self):
+        hashed = password_hash(u'password')
+        self.assertTrue(hashed.startswith('pbkdf2$'))
+        self.assertTrue(len(hashed) <= 100)
+        self.assertNotEqual(hashed, password_hash(u'password'))
+        self.assertEqual(check_password(u'password', hashed), (True, False))
+        self.assertEqual(check_password(u'wrong', hashed), (False, False))
+
+    def test_legacy_password_hash(self):
+        hashed = legacy_password_hash('password')
+        self.assertEqual(check_password('password', hashed), (True, True))
+        self.assertEqual(check_password('wrong', hashed), (False, False))
+
+    def test_rehash_iterations(self):
+        hashed = password_hash(u'password', iterations=1000)
+        self.assertEqual(check_password(u'password', hashed), (True, True))
@@ -0,0 +1,110 @@
+import json
+import unittest
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from sqlalchemy import or_, and_
+
+from dnsforever.config import page_size, max_page_size
+from dnsforever.models import Base, Session, engine, Domain, Record, RecordA
+
+
+class Page(object):
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(name, id):
+    return urlsafe_b64encode(json.dumps([name, id])).rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        cursor = str(cursor)
+        name, id = json.loads(urlsafe_b64decode(cursor +
+                                                '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    if not (name is None or isinstance(name, basestring)) or \
+            not isinstance(id, int):
+        return None
+    return name, id
+
+
+def page_limit(limit):
+    try:
+        return min(max(int(limit), 1), max_page_size)
+    except (TypeError, ValueError):
+        return page_size
+
+
+def paginate(query, name, id, cursor=None, limit=page_size,
+             key=lambda row: (row.name, row.id)):
+    after = decode_cursor(cursor)
+
+    # NULL names (the apex) come first. Databases disagree on where NULLs
+    # sort, so they are read on their own, ordered by id.
+    items = []
+    if after is None or after[0] is None:
+        apex = query.filter(name.is_(None))
+        if after is not None:
+            apex = apex.filter(id > after[1])
+        items = apex.order_by(id).limit(limit + 1).all()
+        after = None
+
+    if len(items) <= limit:
+        named = query.filter(name.isnot(None))
+        if after is not None:
+            named = named.filter(or_(name > after[0],
+                                     and_(name == after[0], id > after[1])))
+        items += named.order_by(name, id).limit(limit + 1 - len(items)).all()
+
+    if len(items) <= limit:
+        return Page(items, None)
+
+    items = items[:limit]
+    return Page(items, encode_cursor(*key(items[-1])))
+
+
+class PaginateTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+
+    def test_paginate(self):
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        names = [None, None, None, 'a', 'a', 'b', 'c', 'd', 'e']
+        with s.begin():
+            for i, name in enumerate(names):
+                s.add(RecordA(domain=domain, name=name, ip='1.1.1.%d' % i))
+
+        query = s.query(Record).filter(Record.domain_id == domain.id)
+        seen = []
+        cursor = None
+        while True:
+            page = paginate(query, Record.name, Record.id, cursor, limit=3)
+            seen.extend(record.name for record in page)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        self.assertEqual(seen, names)
+
+    def test_decode_cursor(self):
+        self.assertEqual(decode_cursor(encode_cursor(u'www', 3)),
+                         (u'www', 3))
+        self.assertEqual(decode_cursor(encode_cursor(None, 1)), (None, 1))
+        self.assertIsNone(decode_cursor('garbage'))
+        self.assertIsNone(decode_cursor(encode_cursor(u'www', u'3')))
+        self.assertEqual(page_limit('5000'), max_page_size)
+        self.assertEqual(page_limit('x'), page_size)
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
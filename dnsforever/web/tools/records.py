@@ -0,0 +1,278 @@
+import unittest
+
+from sqlalchemy.orm import with_polymorphic
+from werkzeug.datastructures import MultiDict
+
+from dnsforever.models import Base, Session, engine, Domain, Record, \
+    RecordA, RecordAAAA, RecordCNAME, RecordMX, RecordTXT
+from dnsforever.zone import record_names, cname_conflicts
+from dnsforever.web.domain_a import RecordAForm
+from dnsforever.web.domain_aaaa import RecordAAAAForm
+from dnsforever.web.domain_cname import RecordCNAMEForm
+from dnsforever.web.domain_mx import RecordMXForm
+from dnsforever.web.domain_txt import RecordTXTForm
+
+# Record types editable through the API, validated with the same forms as
+# the HTML views.
+RECORD_TYPES = {
+    'A': (RecordA, RecordAForm, ('ip', 'memo')),
+    'AAAA': (RecordAAAA, RecordAAAAForm, ('ip', 'memo')),
+    'CNAME': (RecordCNAME, RecordCNAMEForm, ('target', 'memo')),
+    'MX': (RecordMX, RecordMXForm, ('target', 'preference')),
+    'TXT': (RecordTXT, RecordTXTForm, ('txt',)),
+}
+
+DEFAULT_TTL = 3600
+MIN_TTL = 60
+MAX_TTL = 7 * 24 * 3600
+
+
+class RecordError(ValueError):
+    def __init__(self, errors):
+        ValueError.__init__(self, 'Invalid record operations.')
+        self.errors = errors
+
+
+def record_dict(record):
+    data = {'id': record.id,
+            'type': record.service,
+            'name': record.name,
+            'ttl': record.ttl,
+            'rdata': record.rdata}
+    if record.service in RECORD_TYPES:
+        for field in RECORD_TYPES[record.service][2]:
+            data[field] = getattr(record, field)
+    return data
+
+
+def validate_record(type, values):
+    _, form_class, _ = RECORD_TYPES[type]
+    form = form_class(MultiDict((key, unicode(value))
+                                for key, value in values.items()
+                                if value is not None))
+
+    errors = {}
+    if not form.validate():
+        errors.update(form.errors)
+
+    try:
+        ttl = int(values.get('ttl') or DEFAULT_TTL)
+        if not MIN_TTL <= ttl <= MAX_TTL:
+            raise ValueError
+    except (TypeError, ValueError):
+        ttl = None
+        errors['ttl'] = ['TTL must be between %d and %d.' %
+                         (MIN_TTL, MAX_TTL)]
+    return form, ttl, errors
+
+
+def query_records(session, domain):
+    entity = with_polymorphic(Record, '*')
+    return session.query(entity).filter(entity.domain_id == domain.id)
+
+
+def record_conflicts(session, domain, changes):
+    # (name, type) of every record once the batch has been applied.
+    state = record_names(session, domain)
+
+    checked = []
+    for index, action, target, form, ttl in changes:
+        if action == 'delete':
+            state.pop(target.id, None)
+            continue
+        if action == 'create':
+            key, type = ('new', index), target
+        else:
+            key, type = target.id, target.type
+        state[key] = ((form.name.data or '').lower(), type)
+        checked.append((index, key))
+
+    return [{'index': index, 'errors': {'name': [message]}}
+            for index, message in cname_conflicts(state, checked)]
+
+
+def check_operations(session, domain, operations):
+    ids = [operation.get('id') for operation in operations
+           if isinstance(operation, dict)]
+    records = {}
+    if any(isinstance(id, int) for id in ids):
+        records = dict((record.id, record) for record in
+                       query_records(session, domain)
+                       .filter(Record.id.in_([id for id in ids
+                                              if isinstance(id, int)])))
+
+    errors = []
+    changes = []
+    touched = set()
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            errors.append({'index': index,
+                           'errors': {'op': ['Invalid operation.']}})
+            continue
+
+        action = operation.get('op')
+        if action == 'create':
+            type = operation.get('type')
+            if type not in RECORD_TYPES:
+                errors.append({'index': index,
+                               'errors': {'type': ['Unsupported type.']}})
+                continue
+            form, ttl, form_errors = validate_record(type, operation)
+            if form_errors:
+                errors.append({'index': index, 'errors': form_errors})
+                continue
+            changes.append((index, action, type, form, ttl))
+
+        elif action in ('update', 'delete'):
+            record = records.get(operation.get('id'))
+            if record is None or record.service not in RECORD_TYPES:
+                errors.append({'index': index,
+                               'errors': {'id': ['Record not found.']}})
+                continue
+            if record.id in touched:
+                errors.append({'index': index,
+                               'errors': {'id': ['Record is already '
+                                                 'changed in this batch.']}})
+                continue
+            touched.add(record.id)
+
+            if action == 'delete':
+                changes.append((index, action, record, None, None))
+                continue
+
+            values = record_dict(record)
+            values['name'] = record.name or ''
+            values.update(operation)
+            form, ttl, form_errors = validate_record(record.service, values)
+            if form_errors:
+                errors.append({'index': index, 'errors': form_errors})
+                continue
+            changes.append((index, action, record, form, ttl))
+
+        else:
+            errors.append({'index': index,
+                           'errors': {'op': ['Invalid operation.']}})
+
+    errors.extend(record_conflicts(session, domain, changes))
+    if errors:
+        errors.sort(key=lambda error: error['index'])
+        raise RecordError(errors)
+    return changes
+
+
+def apply_record_operations(session, domain, operations):
+    changes = check_operations(session, domain, operations)
+
+    results = []
+    with session.begin():
+        for index, action, target, form, ttl in changes:
+            if action == 'delete':
+                session.delete(target)
+                results.append((None, target.id))
+                continue
+
+            if action == 'create':
+                record_class, _, fields = RECORD_TYPES[target]
+                record = record_class(domain=domain,
+                                      name=form.name.data or None,
+                                      ttl=ttl,
+                                      **dict((field, form[field].data)
+                                             for field in fields))
+                session.add(record)
+            else:
+                record = target
+                fields = RECORD_TYPES[record.service][2]
+                record.name = form.name.data or None
+                record.ttl = ttl
+                for field in fields:
+                    setattr(record, field, form[field].data)
+            results.append((record, None))
+
+        domain.update()
+        session.flush()
+        results = [record_dict(record) if record is not None
+                   else {'id': deleted_id, 'deleted': True}
+                   for record, deleted_id in results]
+
+    return results
+
+
+class RecordOperationsTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+
+    def test_apply_record_operations(self):
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        with s.begin():
+            s.add(RecordA(domain=domain, name='www', ip='1.2.3.4'))
+            s.add(RecordMX(domain=domain, name=None, preference=10,
+                           target='mx.dnsforever.kr'))
+        www, mx = s.query(Record).order_by(Record.id)
+        serial = domain.update_serial
+
+        results = apply_record_operations(s, domain, [
+            {'op': 'create', 'type': 'A', 'name': 'ftp', 'ip': '5.6.7.8'},
+            {'op': 'update', 'id': www.id, 'ip': '4.3.2.1', 'ttl': 300},
+            {'op': 'delete', 'id': mx.id}])
+
+        self.assertEqual(domain.update_serial, serial + 1)
+        self.assertEqual(results[0]['ip'], '5.6.7.8')
+        self.assertEqual((results[1]['ip'], results[1]['ttl']),
+                         ('4.3.2.1', 300))
+        self.assertEqual(results[2], {'id': mx.id, 'deleted': True})
+        self.assertEqual(sorted(s.query(Record.name, Record.rdata)),
+                         [('ftp', '5.6.7.8'), ('www', '4.3.2.1')])
+
+    def test_invalid_operations(self):
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        with s.begin():
+            s.add(RecordA(domain=domain, name='www', ip='1.2.3.4'))
+        www = s.query(Record).one()
+        serial = domain.update_serial
+
+        with self.assertRaises(RecordError) as cm:
+            apply_record_operations(s, domain, [
+                {'op': 'delete', 'id': www.id},
+                {'op': 'create', 'type': 'A', 'name': 'ftp', 'ip': 'x'},
+                {'op': 'update', 'id': www.id + 100, 'ip': '4.3.2.1'},
+                {'op': 'create', 'type': 'SOA'}])
+
+        self.assertEqual([error['index'] for error in cm.exception.errors],
+                         [1, 2, 3])
+        self.assertEqual(domain.update_serial, serial)
+        self.assertEqual(s.query(Record).count(), 1)
+
+    def test_conflicting_operations(self):
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        with s.begin():
+            s.add(RecordA(domain=domain, name='www', ip='1.2.3.4'))
+            s.add(RecordCNAME(domain=domain, name='ftp',
+                              target='www.dnsforever.kr'))
+        www = s.query(RecordA).one()
+
+        with self.assertRaises(RecordError) as cm:
+            apply_record_operations(s, domain, [
+                {'op': 'create', 'type': 'CNAME', 'name': 'www',
+                 'target': 'a.dnsforever.kr'},
+                {'op': 'create', 'type': 'CNAME', 'name': 'ftp',
+                 'target': 'b.dnsforever.kr'},
+                {'op': 'create', 'type': 'CNAME', 'name': 'mail',
+                 'target': 'c.dnsforever.kr'},
+                {'op': 'create', 'type': 'A', 'name': 'mail',
+                 'ip': '5.6.7.8'}])
+        self.assertEqual([error['index'] for error in cm.exception.errors],
+                         [0, 1, 2, 3])
+
+        # Deleting the A record in the same batch frees its name.
+        apply_record_operations(s, domain, [
+            {'op': 'delete', 'id': www.id},
+            {'op': 'create', 'type': 'CNAME', 'name': 'www',
+             'target': 'a.dnsforever.kr'}])
+        self.assertEqual(sorted(s.query(Record.name, Record.type)),
+                         [('ftp', 'CNAME'), ('www', 'CNAME')])
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
@@ -40,22 +40,40 @@ def login(state=True, redirect_url='/'):
     return dco_func
 
 
+def ownership_query():
+    query = g.session.query(Domain, DomainOwnership.master)
+    query = query.join(DomainOwnership.domain)
+    return query.filter(DomainOwnership.user_id == get_user().id)
+
+
+def get_domain_names(limit):
+    if not get_user():
+        return []
+    query = ownership_query().with_entities(Domain.name)
+    return [name for name, in query.order_by(Domain.name).limit(limit)]
+
+
 def get_domain(domain, master=False):
     if not get_user():
         return None
 
-    query = g.session.query(Domain, DomainOwnership)
-    query = query.join(DomainOwnership.domain)
-    query = query.filter(Domain.name.like(domain))
-    query = query.filter(DomainOwnership.user_id == get_user().id)
-    if master:
-        query = query.filter(DomainOwnership.master)
-
-    if query.count() == 0:
+    # Views and the forms they validate look up the same domain more than
+    # once per request; remember each answer on g.
+    if not hasattr(g, 'ownerships'):
+        g.ownerships = {}
+    name = domain.lower()
+    if name not in g.ownerships:
+        g.ownerships[name] = ownership_query().filter(Domain.name == name)\
+                                              .first()
+
+    ownership = g.ownerships[name]
+    if ownership is None:
         return None
 
-    domain, ownership = query.first()
+    domain, is_master = ownership
+    if master and not is_master:
+        return None
 
-    domain.master = ownership.master
+    domain.master = is_master
 
     return domain
@@ -0,0 +1,325 @@
+import re
+import socket
+import struct
+import unittest
+import SocketServer
+
+from sqlalchemy import select
+
+from dnsforever.models import Base, Session, engine, NameServer, Domain, \
+    Record, RecordA, quote_txt
+from dnsforever.zone import SOA_TTL, soa_record, zone_records, zone_diff
+
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_MX = 15
+TYPE_TXT = 16
+TYPE_AAAA = 28
+TYPE_IXFR = 251
+TYPE_AXFR = 252
+CLASS_IN = 1
+
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NOTAUTH = 9
+RCODE_NOTIMP = 4
+RCODE_REFUSED = 5
+
+# Quoted character-strings of a TXT rdata, with backslash escapes.
+TXT_STRING_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"')
+ESCAPE_PATTERN = re.compile(r'\\(.)')
+
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+
+TYPES = {'A': TYPE_A, 'NS': TYPE_NS, 'CNAME': TYPE_CNAME, 'SOA': TYPE_SOA,
+         'MX': TYPE_MX, 'TXT': TYPE_TXT, 'AAAA': TYPE_AAAA}
+
+MESSAGE_SIZE = 16384
+
+
+def encode_name(name):
+    labels = [label for label in name.encode('ascii').split('.') if label]
+    return ''.join(chr(len(label)) + label for label in labels) + '\0'
+
+
+def read_name(data, offset):
+    labels = []
+    end = None
+    for _ in xrange(128):
+        length = ord(data[offset])
+        if length & 0xc0 == 0xc0:
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack('!H', data[offset:offset + 2])[0] & 0x3fff
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(data[offset:offset + length])
+        offset += length
+    else:
+        raise ValueError('Name compression loop.')
+    return '.'.join(labels), end or offset
+
+
+def owner_name(name, origin):
+    if name == '@':
+        return origin
+    return '%s.%s' % (name, origin)
+
+
+def encode_txt(rdata):
+    rdata = rdata.encode('utf-8')
+    if rdata.startswith('"'):
+        chunks = [ESCAPE_PATTERN.sub(r'\1', chunk)
+                  for chunk in TXT_STRING_PATTERN.findall(rdata)]
+    else:
+        chunks = [rdata[i:i + 255] for i in xrange(0, len(rdata), 255)]
+    return ''.join(chr(len(chunk)) + chunk for chunk in chunks or [''])
+
+
+def encode_rdata(type, rdata):
+    # Record targets are stored as entered in the forms, without the
+    # trailing dot, and are always meant as absolute names.
+    if type == TYPE_A:
+        return socket.inet_aton(rdata)
+    if type == TYPE_AAAA:
+        return socket.inet_pton(socket.AF_INET6, rdata)
+    if type in (TYPE_NS, TYPE_CNAME):
+        return encode_name(rdata)
+    if type == TYPE_MX:
+        preference, target = rdata.split(' ', 1)
+        return struct.pack('!H', int(preference)) + encode_name(target)
+    if type == TYPE_TXT:
+        return encode_txt(rdata)
+    if type == TYPE_SOA:
+        mname, rname, serial, refresh, retry, expire, minimum = rdata.split()
+        return encode_name(mname) + encode_name(rname) + \
+            struct.pack('!IIIII', int(serial), int(refresh), int(retry),
+                        int(expire), int(minimum))
+    raise ValueError('Unsupported record type.')
+
+
+def encode_record(line, ttl, origin):
+    name, type, rdata = line.split(' ', 2)
+    type = TYPES[type]
+    rdata = encode_rdata(type, rdata)
+    return encode_name(owner_name(name, origin)) + \
+        struct.pack('!HHIH', type, CLASS_IN, ttl, len(rdata)) + rdata
+
+
+def parse_query(data):
+    message_id, flags, qdcount, ancount, nscount, arcount = \
+        struct.unpack('!HHHHHH', data[:12])
+    if qdcount != 1:
+        raise ValueError('Expected exactly one question.')
+
+    qname, offset = read_name(data, 12)
+    qtype, qclass = struct.unpack('!HH', data[offset:offset + 4])
+    question = data[12:offset + 4]
+    offset += 4
+
+    serial = None
+    if qtype == TYPE_IXFR and nscount:
+        offset = read_name(data, offset)[1] + 10
+        offset = read_name(data, offset)[1]
+        offset = read_name(data, offset)[1]
+        serial = struct.unpack('!I', data[offset:offset + 4])[0]
+
+    return message_id, qname.lower(), qtype, question, serial
+
+
+def build_messages(message_id, question, records):
+    messages = []
+    body, count = [], 0
+    size = 12 + len(question)
+    for record in records:
+        if count and size + len(record) > MESSAGE_SIZE:
+            messages.append((body, count))
+            body, count = [], 0
+            size = 12 + len(question)
+        body.append(record)
+        count += 1
+        size += len(record)
+    messages.append((body, count))
+
+    return [struct.pack('!HHHHHH', message_id, FLAG_QR | FLAG_AA,
+                        1, count, 0, 0) + question + ''.join(body)
+            for body, count in messages]
+
+
+def error_message(message_id, question, rcode):
+    return struct.pack('!HHHHHH', message_id, FLAG_QR | rcode,
+                       1 if question else 0, 0, 0, 0) + question
+
+
+def axfr_records(origin, records):
+    soa = records[0]
+    return [encode_record(line, ttl, origin)
+            for line, ttl in records + [soa]]
+
+
+def ixfr_records(origin, serial, records, diff):
+    soa = records[0]
+    ttls = dict(records)
+    deleted, added = diff
+
+    lines = [soa, (soa_record(origin, serial), SOA_TTL)]
+    lines.extend((line, SOA_TTL) for line in deleted)
+    lines.append(soa)
+    lines.extend((line, ttls.get(line, SOA_TTL)) for line in added)
+    lines.append(soa)
+    return [encode_record(line, ttl, origin) for line, ttl in lines]
+
+
+def transfer(connection, data):
+    try:
+        message_id, qname, qtype, question, serial = parse_query(data)
+    except (ValueError, IndexError, struct.error):
+        message_id = struct.unpack('!H', data[:2])[0] if len(data) > 1 else 0
+        return [error_message(message_id, '', RCODE_FORMERR)]
+
+    if qtype not in (TYPE_AXFR, TYPE_IXFR):
+        return [error_message(message_id, question, RCODE_NOTIMP)]
+
+    zone = zone_records(connection, qname)
+    if zone is None:
+        return [error_message(message_id, question, RCODE_NOTAUTH)]
+    domain_id, current_serial, records = zone
+
+    try:
+        if qtype == TYPE_IXFR and serial is not None:
+            if serial == current_serial:
+                soa_line, soa_ttl = records[0]
+                return build_messages(message_id, question,
+                                      [encode_record(soa_line, soa_ttl,
+                                                     qname)])
+            diff = zone_diff(connection, domain_id, serial)
+            if diff is not None:
+                return build_messages(message_id, question,
+                                      ixfr_records(qname, serial, records,
+                                                   diff))
+
+        return build_messages(message_id, question,
+                              axfr_records(qname, records))
+    except (KeyError, ValueError, UnicodeError, socket.error, struct.error):
+        # A record that cannot be encoded fails the zone, not the handler.
+        return [error_message(message_id, question, RCODE_SERVFAIL)]
+
+
+def is_nameserver(connection, ip):
+    nameserver = NameServer.__table__
+    return connection.execute(select([nameserver.c.id])
+                              .where(nameserver.c.ip == ip)).first() \
+        is not None
+
+
+def recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class TransferHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        while True:
+            length = recv_exactly(self.request, 2)
+            if length is None:
+                return
+            data = recv_exactly(self.request, struct.unpack('!H', length)[0])
+            if data is None:
+                return
+
+            connection = engine.connect()
+            try:
+                if is_nameserver(connection, self.client_address[0]) or \
+                        self.server.allow_all:
+                    messages = transfer(connection, data)
+                else:
+                    message_id = struct.unpack('!H', data[:2])[0]
+                    messages = [error_message(message_id, '', RCODE_REFUSED)]
+            finally:
+                connection.close()
+
+            for message in messages:
+                self.request.sendall(struct.pack('!H', len(message)) + message)
+
+
+class TransferServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, allow_all=False):
+        SocketServer.TCPServer.__init__(self, address, TransferHandler)
+        self.allow_all = allow_all
+
+
+class TransferTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+
+    def query(self, qname, qtype, serial=None, message_id=1):
+        question = encode_name(qname) + struct.pack('!HH', qtype, CLASS_IN)
+        if serial is None:
+            return struct.pack('!HHHHHH', message_id, 0, 1, 0, 0, 0) + \
+                question
+
+        soa = encode_record(soa_record(qname, serial), SOA_TTL, qname)
+        return struct.pack('!HHHHHH', message_id, 0, 1, 0, 1, 0) + \
+            question + soa
+
+    def test_encode_record(self):
+        self.assertEqual(encode_record('www A 127.0.0.1', 300,
+                                       'dnsforever.kr'),
+                         '\x03www\x0adnsforever\x02kr\0'
+                         '\0\x01\0\x01\0\0\x01\x2c\0\x04\x7f\0\0\x01')
+        self.assertEqual(encode_rdata(TYPE_MX, '10 mx.dnsforever.kr'),
+                         '\0\x0a\x02mx\x0adnsforever\x02kr\0')
+        self.assertEqual(encode_rdata(TYPE_TXT, '"a=b"'), '\x03a=b')
+        self.assertEqual(encode_rdata(TYPE_TXT, '"a\\"b" "c"'),
+                         '\x03a"b\x01c')
+        txt = 'a' * 254 + '"b'
+        self.assertEqual(encode_rdata(TYPE_TXT, quote_txt(txt)),
+                         '\xff' + txt[:255] + '\x01b')
+
+    def test_parse_query(self):
+        message_id, qname, qtype, _, serial = \
+            parse_query(self.query('dnsforever.kr', TYPE_IXFR, 7, 42))
+        self.assertEqual((message_id, qname, qtype, serial),
+                         (42, 'dnsforever.kr', TYPE_IXFR, 7))
+
+    def test_build_messages(self):
+        records = [encode_record('www A 127.0.0.1', 300, 'dnsforever.kr')]
+        messages = build_messages(1, '', records * 2000)
+        self.assertTrue(len(messages) > 1)
+        self.assertTrue(all(len(message) <= MESSAGE_SIZE
+                            for message in messages))
+        self.assertEqual(sum(struct.unpack('!H', message[6:8])[0]
+                             for message in messages), 2000)
+
+    def test_transfer_servfail(self):
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        with s.begin():
+            s.add(RecordA(domain=domain, name='www', ip='127.0.0.1'))
+        engine.execute(Record.__table__.update().values(rdata='bad'))
+
+        connection = engine.connect()
+        try:
+            messages = transfer(connection,
+                                self.query('dnsforever.kr', TYPE_AXFR))
+        finally:
+            connection.close()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(struct.unpack('!H', messages[0][2:4])[0] & 0xf,
+                         RCODE_SERVFAIL)
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
@@ -0,0 +1,246 @@
+from collections import defaultdict
+from itertools import groupby
+import unittest
+
+from sqlalchemy import select
+
+from dnsforever.models import Base, Session, engine, Domain, Record, \
+    RecordChange, RecordA, RecordMX, record_line
+from dnsforever.zonecache import MemoryZoneCache
+
+SOA_FORMAT = '@ SOA ns1.dnsforever.kr. root.%s. %d 3600 600 86400 3600'
+SOA_TTL = 3600
+
+
+def soa_record(domain_name, serial):
+    return SOA_FORMAT % (domain_name, serial)
+
+
+def record_names(session, domain):
+    return dict((id, ((name or '').lower(), type)) for id, name, type in
+                session.query(Record.id, Record.name, Record.type)
+                       .filter(Record.domain_id == domain.id))
+
+
+def cname_conflicts(state, checked):
+    # state maps every record key to its (name, type), '' being the apex,
+    # as the zone will be after a change; checked lists the (index, key)
+    # pairs the change adds or edits.
+    names = defaultdict(list)
+    for key, (name, type) in state.items():
+        names[name].append((key, type))
+
+    # A CNAME must be the only record at its name, and the apex always
+    # has the SOA and NS records.
+    conflicts = []
+    for index, key in checked:
+        name, type = state[key]
+        others = [other for other_key, other in names[name]
+                  if other_key != key]
+        if type == 'CNAME' and not name:
+            message = 'A CNAME record cannot be at the zone apex.'
+        elif type == 'CNAME' and 'CNAME' in others:
+            message = 'Already exists.'
+        elif type == 'CNAME' and others:
+            message = 'Other records exist at this name.'
+        elif 'CNAME' in others:
+            message = 'A CNAME record exists at this name.'
+        else:
+            continue
+        conflicts.append((index, message))
+    return conflicts
+
+
+def zone_query(updated_since=None):
+    domain = Domain.__table__
+    record = Record.__table__
+
+    query = select([domain.c.id, domain.c.name, domain.c.update_serial,
+                    domain.c.updated_at,
+                    record.c.name, record.c.type, record.c.rdata])
+    query = query.select_from(domain.outerjoin(record,
+                                               record.c.domain_id ==
+                                               domain.c.id))
+    if updated_since is not None:
+        query = query.where(domain.c.updated_at > updated_since)
+    return query.order_by(domain.c.id, record.c.id)
+
+
+def export_zones(connection, updated_since=None, stream=False):
+    query = zone_query(updated_since)
+    if stream:
+        query = query.execution_options(stream_results=True)
+
+    rows = connection.execute(query)
+    for _, zone_rows in groupby(rows, key=lambda row: row[0]):
+        zone_rows = list(zone_rows)
+        _, domain_name, serial, updated_at = zone_rows[0][:4]
+
+        records = [soa_record(domain_name, serial)]
+        records.extend(record_line(name, type, rdata)
+                       for _, _, _, _, name, type, rdata in zone_rows
+                       if type is not None)
+
+        yield domain_name, serial, updated_at, records
+
+
+def domain_query(updated_since=None):
+    domain = Domain.__table__
+
+    query = select([domain.c.id, domain.c.name, domain.c.update_serial,
+                    domain.c.updated_at])
+    if updated_since is not None:
+        query = query.where(domain.c.updated_at > updated_since)
+    return query.order_by(domain.c.id)
+
+
+def record_query(domain_ids):
+    record = Record.__table__
+
+    query = select([record.c.domain_id,
+                    record.c.name, record.c.type, record.c.rdata])
+    query = query.where(record.c.domain_id.in_(domain_ids))
+    return query.order_by(record.c.domain_id, record.c.id)
+
+
+def export_cached_zones(connection, cache, updated_since=None,
+                        chunk_size=500):
+    domains = connection.execute(domain_query(updated_since)).fetchall()
+
+    zones = {}
+    missing = []
+    for domain_id, domain_name, serial, _ in domains:
+        records = cache.get(domain_id, serial)
+        if records is None:
+            missing.append(domain_id)
+            records = [soa_record(domain_name, serial)]
+        zones[domain_id] = records
+
+    for i in xrange(0, len(missing), chunk_size):
+        rows = connection.execute(record_query(missing[i:i + chunk_size]))
+        for domain_id, name, type, rdata in rows:
+            zones[domain_id].append(record_line(name, type, rdata))
+
+    missing = set(missing)
+    for domain_id, domain_name, serial, updated_at in domains:
+        if domain_id in missing:
+            cache.set(domain_id, serial, zones[domain_id])
+        yield domain_name, serial, updated_at, zones[domain_id]
+
+
+def zone_records(connection, domain_name):
+    domain = Domain.__table__
+    record = Record.__table__
+
+    row = connection.execute(select([domain.c.id, domain.c.update_serial])
+                             .where(domain.c.name == domain_name)).first()
+    if row is None:
+        return None
+    domain_id, serial = row
+
+    rows = connection.execute(select([record.c.name, record.c.type,
+                                      record.c.rdata, record.c.ttl])
+                              .where(record.c.domain_id == domain_id)
+                              .order_by(record.c.id))
+
+    records = [(soa_record(domain_name, serial), SOA_TTL)]
+    records.extend((record_line(name, type, rdata), ttl)
+                   for name, type, rdata, ttl in rows)
+    return domain_id, serial, records
+
+
+def zone_diff(connection, domain_id, serial):
+    change = RecordChange.__table__
+
+    start = connection.execute(
+        select([change.c.id])
+        .where(change.c.domain_id == domain_id)
+        .where(change.c.action == 'serial')
+        .where(change.c.serial == serial)
+        .order_by(change.c.id.desc())).first()
+    if start is None:
+        return None
+
+    rows = connection.execute(select([change.c.action, change.c.old,
+                                      change.c.new])
+                              .where(change.c.domain_id == domain_id)
+                              .where(change.c.id > start[0])
+                              .order_by(change.c.id))
+
+    deleted, added = [], []
+    for action, old, new in rows:
+        if old is not None:
+            if old in added:
+                added.remove(old)
+            else:
+                deleted.append(old)
+        if new is not None:
+            added.append(new)
+    return deleted, added
+
+
+class ExportZonesTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        s = Session()
+        domain = Domain(name='dnsforever.kr')
+        empty_domain = Domain(name='empty.kr')
+
+        with s.begin():
+            s.add(empty_domain)
+            s.add(RecordA(domain=domain, name='www', ip='127.0.0.1'))
+            s.add(RecordMX(domain=domain, name=None, preference=10,
+                           target='mx.dnsforever.kr'))
+
+    def test_export_zones(self):
+        zones = dict((name, records) for name, _, _, records in
+                     export_zones(engine.connect()))
+
+        self.assertEqual(zones['empty.kr'], [soa_record('empty.kr', 1)])
+        self.assertEqual(zones['dnsforever.kr'],
+                         [soa_record('dnsforever.kr', 1),
+                          'www A 127.0.0.1',
+                          '@ MX 10 mx.dnsforever.kr'])
+
+    def test_export_cached_zones(self):
+        cache = MemoryZoneCache()
+        zones = list(export_zones(engine.connect()))
+        self.assertEqual(list(export_cached_zones(engine.connect(), cache)),
+                         zones)
+
+        record_table = Record.__table__
+        engine.execute(record_table.update().values(rdata='127.0.0.2')
+                       .where(record_table.c.type == 'A'))
+        self.assertEqual(list(export_cached_zones(engine.connect(), cache)),
+                         zones)
+
+    def test_zone_diff(self):
+        s = Session()
+        domain = s.query(Domain).filter(Domain.name == 'dnsforever.kr').one()
+        record = s.query(RecordA).filter(RecordA.domain == domain).one()
+        domain_id = domain.id
+
+        with s.begin():
+            s.add(RecordA(domain=domain, name='tmp', ip='127.0.0.3'))
+            record.ip = '127.0.0.2'
+            record.update()
+
+        with s.begin():
+            tmp = s.query(RecordA).filter(RecordA.name == 'tmp').one()
+            tmp.update()
+            s.delete(tmp)
+
+        connection = engine.connect()
+        self.assertEqual(zone_diff(connection, domain_id, 1),
+                         (['www A 127.0.0.1'], ['www A 127.0.0.2']))
+        self.assertEqual(zone_diff(connection, domain_id, 2),
+                         (['tmp A 127.0.0.3'], []))
+        self.assertEqual(zone_diff(connection, domain_id, 3), ([], []))
+        self.assertIsNone(zone_diff(connection, domain_id, 4))
+
+        _, serial, records = zone_records(connection, 'dnsforever.kr')
+        self.assertEqual(serial, 3)
+        self.assertEqual(records[0], (soa_record('dnsforever.kr', 3), 3600))
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
@@ -0,0 +1,189 @@
+import os
+import stat
+import errno
+import marshal
+import unittest
+import tempfile
+import shutil
+from collections import OrderedDict
+from threading import Lock
+
+from dnsforever.config import zone_cache_backend, zone_cache_size, \
+    zone_cache_path
+
+
+class MemoryZoneCache(object):
+    def __init__(self, size=zone_cache_size):
+        self.size = size
+        self.zones = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, domain_id, serial):
+        with self.lock:
+            records = self.zones.pop((domain_id, serial), None)
+            if records is not None:
+                self.zones[(domain_id, serial)] = records
+            return records
+
+    def set(self, domain_id, serial, records):
+        with self.lock:
+            self.zones.pop((domain_id, serial), None)
+            self.zones[(domain_id, serial)] = records
+            while len(self.zones) > self.size:
+                self.zones.popitem(last=False)
+
+
+class FileZoneCache(object):
+    def __init__(self, path=zone_cache_path, size=zone_cache_size):
+        if path is None:
+            raise ValueError('zone_cache_path is not set.')
+        self.path = path
+        self.size = size
+        try:
+            os.makedirs(path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Cached zones are served to the nameservers as they are, so only
+        # a directory nobody else can write to is trusted.
+        st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+                st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise ValueError('%s must be a directory owned by this user and '
+                             'not writable by group or others.' % path)
+
+        # Every worker writes to the same directory; each lists it once per
+        # evict_interval writes and trims it back to size.
+        self.evict_interval = max(1, size // 10)
+        self.writes = 0
+        self.lock = Lock()
+        self.evict()
+
+    def filename(self, domain_id):
+        return os.path.join(self.path, '%d.zone' % domain_id)
+
+    def get(self, domain_id, serial):
+        filename = self.filename(domain_id)
+        try:
+            with open(filename, 'rb') as f:
+                if marshal.load(f) != serial:
+                    return None
+                records = marshal.load(f)
+            os.utime(filename, None)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        return records
+
+    def cached_serial(self, domain_id):
+        try:
+            with open(self.filename(domain_id), 'rb') as f:
+                return marshal.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def set(self, domain_id, serial, records):
+        # One file per zone: a newer serial replaces the old file, and a
+        # late write of an older serial is dropped.
+        cached = self.cached_serial(domain_id)
+        if cached is not None and cached > serial:
+            return
+
+        fd, tmpname = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(serial, f)
+            marshal.dump(records, f)
+        os.rename(tmpname, self.filename(domain_id))
+
+        with self.lock:
+            self.writes += 1
+            if self.writes % self.evict_interval:
+                return
+        self.evict()
+
+    def evict(self):
+        names = [name for name in os.listdir(self.path)
+                 if name.endswith('.zone')]
+        if len(names) <= self.size:
+            return
+
+        files = []
+        for name in names:
+            filename = os.path.join(self.path, name)
+            try:
+                files.append((os.stat(filename).st_mtime, filename))
+            except OSError:
+                continue
+
+        files.sort()
+        for _, filename in files[:len(files) - self.size]:
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+
+ZONE_CACHE_BACKENDS = {
+    'memory': MemoryZoneCache,
+    'file': FileZoneCache,
+}
+
+
+def create_zone_cache(backend=zone_cache_backend):
+    if backend is None:
+        return None
+    return ZONE_CACHE_BACKENDS[backend]()
+
+
+class MemoryZoneCacheTestCase(unittest.TestCase):
+    def test_lru(self):
+        cache = MemoryZoneCache(size=2)
+        cache.set(1, 1, ['a'])
+        cache.set(2, 1, ['b'])
+        self.assertEqual(cache.get(1, 1), ['a'])
+
+        cache.set(3, 1, ['c'])
+        self.assertIsNone(cache.get(2, 1))
+        self.assertEqual(cache.get(1, 1), ['a'])
+        self.assertEqual(cache.get(3, 1), ['c'])
+        self.assertIsNone(cache.get(1, 2))
+
+
+class FileZoneCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def test_file_cache(self):
+        cache = FileZoneCache(path=self.path, size=1)
+        cache.set(1, 1, ['a'])
+        self.assertEqual(FileZoneCache(path=self.path).get(1, 1), ['a'])
+
+        cache.set(1, 2, ['b'])
+        self.assertEqual(os.listdir(self.path), ['1.zone'])
+        self.assertIsNone(cache.get(1, 1))
+
+        # A late write of an older serial does not replace the newer one.
+        cache.set(1, 1, ['a'])
+        self.assertEqual(cache.get(1, 2), ['b'])
+
+    def test_evict(self):
+        cache = FileZoneCache(path=self.path, size=2)
+        other = FileZoneCache(path=self.path, size=2)
+        cache.set(1, 1, ['a'])
+        other.set(2, 1, ['b'])
+        os.utime(os.path.join(self.path, '1.zone'), (0, 0))
+        cache.set(3, 1, ['c'])
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         ['2.zone', '3.zone'])
+
+    def test_unsafe_path(self):
+        self.assertRaises(ValueError, FileZoneCache, path=None)
+        os.chmod(self.path, 0o777)
+        self.assertRaises(ValueError, FileZoneCache, path=self.path)
+
+        path = os.path.join(self.path, 'zones')
+        FileZoneCache(path=path)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o700)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
@@ -0,0 +1,431 @@
+import re
+import socket
+import unittest
+from StringIO import StringIO
+
+from sqlalchemy import select
+
+from dnsforever.models import Base, Session, engine, Domain, Record, \
+    NameServer, RecordA, RecordAAAA, RecordCNAME, RecordMX, RecordTXT, \
+    RecordNS, check_domain, record_line
+from dnsforever.zone import SOA_TTL, soa_record, record_names, \
+    cname_conflicts
+
+DEFAULT_TTL = 3600
+MAX_TTL = 2 ** 31 - 1
+TTL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+TTL_PATTERN = re.compile(r'^(\d+[smhdw]?)+$', re.I)
+TTL_PART_PATTERN = re.compile(r'(\d+)([smhdw]?)', re.I)
+IPV4_PATTERN = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
+LABEL_PATTERN = re.compile(r'^[a-z0-9\-_]+$')
+
+RECORD_CLASSES = {
+    'A': lambda domain, name, ttl, rdata:
+        RecordA(domain=domain, name=name, ip=rdata, ttl=ttl),
+    'AAAA': lambda domain, name, ttl, rdata:
+        RecordAAAA(domain=domain, name=name, ip=rdata, ttl=ttl),
+    'CNAME': lambda domain, name, ttl, rdata:
+        RecordCNAME(domain=domain, name=name, target=rdata, ttl=ttl),
+    'MX': lambda domain, name, ttl, rdata:
+        RecordMX(domain=domain, name=name, ttl=ttl,
+                 preference=int(rdata.split(' ', 1)[0]),
+                 target=rdata.split(' ', 1)[1]),
+    'TXT': lambda domain, name, ttl, rdata:
+        RecordTXT(domain=domain, name=name, txt=rdata, ttl=ttl),
+    'NS': lambda domain, name, ttl, rdata:
+        RecordNS(domain=domain, name=name, target=rdata, ttl=ttl),
+}
+
+# Our own SOA and apex NS records are generated, never imported.
+GENERATED_TYPES = ('SOA',)
+
+
+class ZoneFileError(ValueError):
+    def __init__(self, errors):
+        ValueError.__init__(self, '\n'.join('line %d: %s' % error
+                                            for error in errors))
+        self.errors = errors
+
+
+def split_line(line):
+    tokens = []
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if c in ' \t\r\n':
+            i += 1
+        elif c == ';':
+            break
+        elif c in '()':
+            tokens.append(c)
+            i += 1
+        elif c == '"':
+            j = i + 1
+            while j < len(line) and line[j] != '"':
+                if line[j] == '\\':
+                    j += 1
+                j += 1
+            if j >= len(line):
+                raise ValueError('Unterminated quoted string.')
+            tokens.append(line[i:j + 1])
+            i = j + 1
+        else:
+            j = i
+            while j < len(line) and line[j] not in ' \t\r\n;()"':
+                if line[j] == '\\':
+                    j += 1
+                j += 1
+            tokens.append(line[i:j])
+            i = j
+    return tokens
+
+
+def read_entries(fileobj):
+    tokens, start, depth, blank_owner = [], None, 0, False
+    for lineno, line in enumerate(fileobj, 1):
+        try:
+            line_tokens = split_line(line)
+        except ValueError as e:
+            raise ZoneFileError([(lineno, str(e))])
+
+        if depth == 0:
+            if not line_tokens:
+                continue
+            start = lineno
+            blank_owner = line[:1] in (' ', '\t')
+
+        for token in line_tokens:
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+                if depth < 0:
+                    raise ZoneFileError([(lineno, 'Unbalanced parenthesis.')])
+            else:
+                tokens.append(token)
+
+        if depth == 0 and tokens:
+            yield start, blank_owner, tokens
+            tokens = []
+
+    if depth:
+        raise ZoneFileError([(start, 'Unbalanced parenthesis.')])
+
+
+def unescape(text):
+    result = []
+    i = 0
+    while i < len(text):
+        if text[i] == '\\' and i + 1 < len(text):
+            if text[i + 1:i + 4].isdigit():
+                result.append(chr(int(text[i + 1:i + 4])))
+                i += 4
+                continue
+            i += 1
+        result.append(text[i])
+        i += 1
+    return ''.join(result)
+
+
+def parse_ttl(token):
+    if not TTL_PATTERN.match(token):
+        raise ValueError('Invalid TTL %s.' % token)
+    ttl = sum(int(value) * TTL_UNITS[unit.lower() or 's']
+              for value, unit in TTL_PART_PATTERN.findall(token))
+    if ttl > MAX_TTL:
+        raise ValueError('TTL %s is too large.' % token)
+    return ttl
+
+
+def absolute_name(name, origin):
+    name = unescape(name).lower()
+    if name == '@':
+        name = origin
+    elif name.endswith('.'):
+        name = name[:-1]
+    else:
+        name = '%s.%s' % (name, origin)
+
+    labels = name.split('.')
+    if labels[0] == '*':
+        labels = labels[1:]
+    if not all(LABEL_PATTERN.match(label) for label in labels):
+        raise ValueError('Invalid name %s.' % name)
+    check_domain(name)
+    return name
+
+
+def relative_name(name, zone):
+    if name == zone:
+        return None
+    if name.endswith('.' + zone):
+        return name[:-len(zone) - 1]
+    raise ValueError('%s is outside of %s.' % (name, zone))
+
+
+def parse_rdata(type, tokens, origin):
+    if type == 'A':
+        if len(tokens) != 1 or not IPV4_PATTERN.match(tokens[0]):
+            raise ValueError('Invalid A record.')
+        socket.inet_aton(tokens[0])
+        return tokens[0]
+
+    if type == 'AAAA':
+        if len(tokens) != 1:
+            raise ValueError('Invalid AAAA record.')
+        return socket.inet_ntop(socket.AF_INET6,
+                                socket.inet_pton(socket.AF_INET6,
+                                                 tokens[0]))
+
+    if type in ('CNAME', 'NS'):
+        if len(tokens) != 1:
+            raise ValueError('Invalid %s record.' % type)
+        return absolute_name(tokens[0], origin)
+
+    if type == 'MX':
+        if len(tokens) != 2 or not tokens[0].isdigit() or \
+                int(tokens[0]) > 65535:
+            raise ValueError('Invalid MX record.')
+        return '%d %s' % (int(tokens[0]), absolute_name(tokens[1], origin))
+
+    if type == 'TXT':
+        if not tokens:
+            raise ValueError('Invalid TXT record.')
+        txt = ''.join(unescape(token[1:-1] if token.startswith('"')
+                               else token)
+                      for token in tokens)
+        try:
+            txt.decode('ascii')
+        except UnicodeDecodeError:
+            raise ValueError('TXT records may only contain ASCII.')
+        if len(txt) > 255:
+            raise ValueError('TXT record is longer than 255 characters.')
+        return txt
+
+    raise ValueError('Unsupported record type %s.' % type)
+
+
+def parse_zone(fileobj, zone, errors):
+    origin = zone
+    default_ttl = None
+    last_ttl = None
+    last_owner = None
+
+    for lineno, blank_owner, tokens in read_entries(fileobj):
+        try:
+            if tokens[0].startswith('$'):
+                directive = tokens[0].upper()
+                if directive == '$ORIGIN' and len(tokens) == 2:
+                    origin = absolute_name(tokens[1], zone)
+                elif directive == '$TTL' and len(tokens) == 2:
+                    default_ttl = parse_ttl(tokens[1])
+                else:
+                    raise ValueError('Unsupported directive %s.' % tokens[0])
+                continue
+
+            if blank_owner:
+                if last_owner is None:
+                    raise ValueError('Missing owner name.')
+                owner = last_owner
+            else:
+                owner = absolute_name(tokens.pop(0), origin)
+                last_owner = owner
+
+            ttl = None
+            while tokens:
+                if tokens[0][0].isdigit():
+                    ttl = parse_ttl(tokens.pop(0))
+                elif tokens[0].upper() == 'IN':
+                    tokens.pop(0)
+                else:
+                    break
+            if not tokens:
+                raise ValueError('Missing record type.')
+            type = tokens.pop(0).upper()
+
+            if ttl is not None:
+                last_ttl = ttl
+            else:
+                ttl = default_ttl or last_ttl or DEFAULT_TTL
+
+            name = relative_name(owner, zone)
+            if type in GENERATED_TYPES or (type == 'NS' and name is None):
+                continue
+
+            yield lineno, name, ttl, type, parse_rdata(type, tokens, origin)
+        except (ValueError, socket.error) as e:
+            errors.append((lineno, str(e) or 'Invalid record.'))
+
+
+def import_zone(session, domain, fileobj):
+    errors = []
+    entries = list(parse_zone(fileobj, domain.name, errors))
+    if errors:
+        raise ZoneFileError(errors)
+
+    existing = set(record_line(name, type, rdata) for name, type, rdata in
+                   session.query(Record.name, Record.type, Record.rdata)
+                          .filter(Record.domain_id == domain.id))
+    state = record_names(session, domain)
+
+    records = []
+    checked = []
+    for lineno, name, ttl, type, rdata in entries:
+        # Built detached so that duplicates never reach the session; the
+        # model normalizes rdata before it is compared.
+        record = RECORD_CLASSES[type](None, name, ttl, rdata)
+        if record.line in existing:
+            continue
+        existing.add(record.line)
+        state[('new', lineno)] = ((name or '').lower(), record.type)
+        checked.append((lineno, ('new', lineno)))
+        records.append(record)
+
+    # The same CNAME rules as the record forms and the API.
+    errors = cname_conflicts(state, checked)
+    if errors:
+        raise ZoneFileError(errors)
+
+    for record in records:
+        record.domain = domain
+
+    if records:
+        with session.begin():
+            session.add_all(records)
+            domain.update()
+
+    return len(records), len(entries) - len(records)
+
+
+def format_rdata(type, rdata):
+    if type in ('CNAME', 'NS'):
+        return rdata + '.'
+    if type == 'MX':
+        preference, target = rdata.split(' ', 1)
+        return '%s %s.' % (preference, target)
+    return rdata
+
+
+def format_record(name, ttl, type, rdata):
+    return '%-24s %7d IN %-5s %s\n' % (name or '@', ttl, type,
+                                      format_rdata(type, rdata))
+
+
+def zone_file(connection, domain):
+    record = Record.__table__
+    nameserver = NameServer.__table__
+
+    yield '$ORIGIN %s.\n' % domain.name
+    yield '$TTL %d\n' % DEFAULT_TTL
+    _, _, soa = soa_record(domain.name, domain.update_serial).split(' ', 2)
+    yield '%-24s %7d IN %-5s %s\n' % ('@', SOA_TTL, 'SOA', soa)
+
+    for ns, in connection.execute(select([nameserver.c.domain])
+                                  .order_by(nameserver.c.id)):
+        yield format_record(None, SOA_TTL, 'NS', ns)
+
+    rows = connection.execute(
+        select([record.c.name, record.c.ttl, record.c.type, record.c.rdata])
+        .where(record.c.domain_id == domain.id)
+        .where(record.c.service != 'servicenameserver')
+        .order_by(record.c.name, record.c.type, record.c.id)
+        .execution_options(stream_results=True))
+    for name, ttl, type, rdata in rows:
+        yield format_record(name, ttl, type, rdata)
+
+
+ZONE_FILE = '''$ORIGIN dnsforever.kr.
+$TTL 1h
+@       IN SOA ns.example.com. root.example.com. (
+            2014010101 ; serial
+            3600 600 86400 3600 )
+        IN NS   ns.example.com.
+        IN MX   10 mail
+www  300 IN A   127.0.0.1
+         IN AAAA 2001:DB8::0001
+mail     IN CNAME www
+txt      IN TXT "v=spf1 \\"a\\"" " -all"
+$ORIGIN sub.dnsforever.kr.
+*        IN A   127.0.0.2
+         IN NS  ns1.other.net.
+'''
+
+
+class ZoneFileTestCase(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(engine)
+        s = Session()
+        with s.begin():
+            s.add(Domain(name='dnsforever.kr'))
+
+    def test_parse_zone(self):
+        errors = []
+        entries = list(parse_zone(StringIO(ZONE_FILE), 'dnsforever.kr',
+                                  errors))
+        self.assertEqual(errors, [])
+        self.assertEqual([entry[1:] for entry in entries],
+                         [(None, 3600, 'MX', '10 mail.dnsforever.kr'),
+                          ('www', 300, 'A', '127.0.0.1'),
+                          ('www', 3600, 'AAAA', '2001:db8::1'),
+                          ('mail', 3600, 'CNAME', 'www.dnsforever.kr'),
+                          ('txt', 3600, 'TXT', 'v=spf1 "a" -all'),
+                          ('*.sub', 3600, 'A', '127.0.0.2'),
+                          ('*.sub', 3600, 'NS', 'ns1.other.net')])
+
+    def test_parse_errors(self):
+        errors = []
+        list(parse_zone(StringIO('www IN A 300.0.0.1\n'
+                                 'ftp.other.kr. IN A 127.0.0.1\n'
+                                 'srv IN SRV 0 0 80 www\n'
+                                 'ok IN A 127.0.0.1\n'),
+                        'dnsforever.kr', errors))
+        self.assertEqual([lineno for lineno, _ in errors], [1, 2, 3])
+
+        self.assertRaises(ZoneFileError, list,
+                          parse_zone(StringIO('www IN TXT "open\n'),
+                                     'dnsforever.kr', []))
+
+    def test_import_export(self):
+        s = Session()
+        domain = s.query(Domain).filter(Domain.name == 'dnsforever.kr').one()
+
+        self.assertEqual(import_zone(s, domain, StringIO(ZONE_FILE)), (7, 0))
+        self.assertEqual(import_zone(s, domain, StringIO(ZONE_FILE)), (0, 7))
+        self.assertEqual(domain.update_serial, 2)
+
+        self.assertRaises(ZoneFileError, import_zone, s, domain,
+                          StringIO(ZONE_FILE + 'bad IN A 1.2.3\n'))
+        self.assertEqual(domain.update_serial, 2)
+
+        exported = ''.join(zone_file(s, domain))
+        self.assertIn('txt 3600 IN TXT "v=spf1 \\"a\\" -all"',
+                      ' '.join(exported.split()))
+
+        errors = []
+        self.assertEqual(sorted(entry[1:] for entry in
+                                parse_zone(StringIO(exported),
+                                           'dnsforever.kr', errors)),
+                         sorted(entry[1:] for entry in
+                                parse_zone(StringIO(ZONE_FILE),
+                                           'dnsforever.kr', [])))
+        self.assertEqual(errors, [])
+
+    def test_import_conflicts(self):
+        s = Session()
+        domain = s.query(Domain).filter(Domain.name == 'dnsforever.kr').one()
+        with s.begin():
+            s.add(RecordA(domain=domain, name='www', ip='127.0.0.1'))
+
+        with self.assertRaises(ZoneFileError) as cm:
+            import_zone(s, domain, StringIO('www IN CNAME other.kr.\n'
+                                            '@ IN CNAME other.kr.\n'
+                                            'ftp IN CNAME other.kr.\n'
+                                            'ftp IN TXT "x"\n'
+                                            'mail IN CNAME other.kr.\n'))
+        self.assertEqual([lineno for lineno, _ in cm.exception.errors],
+                         [1, 2, 3, 4])
+        self.assertEqual(s.query(Record).count(), 1)
+        self.assertEqual(domain.update_serial, 1)
+
+    def tearDown(self):
+        Base.metadata.drop_all(engine)
@@ -1,8 +1,20 @@
 #!/usr/bin/env python
+import logging
+import sys
+import time
+
 from flask.ext.script import Manager
 from dnsforever import web
-from dnsforever.models import Base, engine, Session, NameServer
-from dnsforever.web.tools import password_hash
+from dnsforever.backfill import add_typed_columns, backfill_all
+from dnsforever.mailqueue import MailSender, enqueue_emails
+from dnsforever.models import Base, engine, Session, NameServer, User, \
+    Domain, ApiToken
+from dnsforever.recordlayout import migrate_records as migrate_record_layout
+from dnsforever.sweeper import sweep_all
+from dnsforever.web.email import render_emails
+from dnsforever.web.tools import password_hash, legacy_password_hash
+from dnsforever.xfr import TransferServer
+from dnsforever.zonefile import import_zone as import_zone_file, zone_file
 
 app = web.create_app()
 manager = Manager(app)
@@ -13,6 +25,202 @@ def run(host='127.0.0.1', port=5000):
     app.run(debug=True, use_reloader=True, host=host, port=int(port))
 
 
+@manager.command
+def xfr(host='0.0.0.0', port=53):
+    server = TransferServer((host, int(port)))
+    server.serve_forever()
+
+
+@manager.command
+def mailer():
+    MailSender().run()
+
+
+@manager.command
+def import_zone(domain, path):
+    session = Session()
+    domain = session.query(Domain).filter(Domain.name == domain).one()
+    with open(path) as fileobj:
+        added, skipped = import_zone_file(session, domain, fileobj)
+    print('%d records added, %d already present' % (added, skipped))
+
+
+@manager.command
+def export_zone(domain):
+    session = Session()
+    domain = session.query(Domain).filter(Domain.name == domain).one()
+    for line in zone_file(session, domain):
+        sys.stdout.write(line)
+
+
+@manager.command
+def create_api_token(email, name):
+    session = Session()
+    user = session.query(User).filter(User.email == email).one()
+    token = ApiToken(user, name)
+    with session.begin():
+        session.add(token)
+    print(token.token)
+
+
+@manager.command
+def sweep(batch_size=1000):
+    for table, removed in sweep_all(int(batch_size)).items():
+        print('%-20s %d expired rows removed' % (table, removed))
+
+
+@manager.command
+def upgrade_rdata(batch_size=1000):
+    for column in add_typed_columns(engine):
+        print('added %s' % column)
+    for type, (filled, failed) in backfill_all(int(batch_size)).items():
+        print('%-20s %d filled, %d unparsable' % (type, filled, failed))
+
+
+@manager.command
+def migrate_records(drop=False):
+    for type, moved in migrate_record_layout(engine, drop).items():
+        print('%-20s %d records moved' % (type, moved))
+
+
+@manager.command
+def mail_users(template, subject):
+    session = Session()
+    ns_list = session.query(NameServer).all()
+    recipients = ((user.email, {'user': user, 'ns_list': ns_list})
+                  for user in session.query(User).all())
+    count = enqueue_emails(session, subject,
+                           render_emails(template, recipients, app))
+    print('%d emails queued' % count)
+
+
+@manager.command
+def bench_email(n=10000):
+    recipients = (('user%d@dnsforever.kr' % i, {'token': 'x' * 40})
+                  for i in xrange(int(n)))
+    start = time.time()
+    for _ in render_emails('find_passwd.txt', recipients, app):
+        pass
+    print('%.1f emails/s' % (int(n) / (time.time() - start)))
+
+
+@manager.command
+def bench_password(n=200, clients=4):
+    from threading import Thread
+
+    def bench(name, func):
+        def worker():
+            for _ in xrange(int(n) / int(clients)):
+                func('password')
+
+        threads = [Thread(target=worker) for _ in xrange(int(clients))]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        print('%-8s %8.1f hashes/s' % (name, int(n) / elapsed))
+
+    bench('legacy', legacy_password_hash)
+    bench('pbkdf2', password_hash)
+
+
+@manager.command
+def bench_public_suffix(n=100000):
+    from timeit import timeit
+    from dnsforever.domain import ROOT_DOMAIN, PUBLIC_SUFFIXES
+
+    names = ['dnsforever.kr', 'jeju.kr', 'www.dnsforever.co.kr', 'aaa']
+    for name in names:
+        scan = timeit(lambda: name in ROOT_DOMAIN, number=int(n))
+        trie = timeit(lambda: name in PUBLIC_SUFFIXES, number=int(n))
+        print('%-24s list %6.2f us  trie %6.2f us' %
+              (name, scan * 1e6 / int(n), trie * 1e6 / int(n)))
+
+
+BENCH_LAYOUT_SCRIPT = '''import sys
+from dnsforever import config
+config.record_layout = sys.argv[1]
+import manage
+manage.bench_records(sys.argv[2], sys.argv[3], sys.argv[1])
+'''
+
+
+@manager.command
+def bench_records(n=100000, zones=10, layout=None):
+    import os
+    import subprocess
+    import tempfile
+    from sqlalchemy.orm import with_polymorphic
+    from dnsforever.config import record_layout
+    from dnsforever.models import create_database_engine, Record, RecordA, \
+        RecordMX, RecordTXT
+
+    if layout != record_layout:
+        # The layout is fixed when the models are mapped, so every other
+        # layout runs in a fresh interpreter.
+        here = os.path.dirname(os.path.abspath(__file__))
+        for layout in [layout] if layout else ['joined', 'single']:
+            subprocess.check_call([sys.executable, '-c', BENCH_LAYOUT_SCRIPT,
+                                   layout, str(n), str(zones)], cwd=here)
+        return
+
+    n, zones = int(n), int(zones)
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    bench_engine = create_database_engine('sqlite:///' + path)
+    Base.metadata.create_all(bench_engine)
+    session = Session(bind=bench_engine)
+
+    def timed(name, func):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        print('%-8s %-28s %8.2f s %10.0f records/s' %
+              (record_layout, name, elapsed, n / elapsed))
+
+    def insert():
+        domains = [Domain(name='zone%d.dnsforever.kr' % i)
+                   for i in xrange(zones)]
+        for start in xrange(0, n, 10000):
+            with session.begin():
+                for i in xrange(start, min(start + 10000, n)):
+                    domain = domains[i % zones]
+                    if i % 3 == 0:
+                        RecordA(domain, 'a%d' % i, '10.%d.%d.%d' %
+                                (i >> 16 & 255, i >> 8 & 255, i & 255))
+                    elif i % 3 == 1:
+                        RecordMX(domain, 'mx%d' % i, i % 100,
+                                 'mx.dnsforever.kr')
+                    else:
+                        RecordTXT(domain, 't%d' % i, 'v=spf1 -all')
+                session.add_all(domains)
+        session.expunge_all()
+
+    def load_polymorphic():
+        entity = with_polymorphic(Record, '*')
+        for domain_id, in session.query(Domain.id):
+            for record in session.query(entity)\
+                                 .filter(entity.domain_id == domain_id):
+                record.line
+            session.expunge_all()
+
+    def load_relationship():
+        for domain_id, in session.query(Domain.id).all():
+            for record in session.query(Domain).get(domain_id).records:
+                getattr(record, 'memo', None)
+            session.expunge_all()
+
+    try:
+        timed('insert', insert)
+        timed('load zones, with_polymorphic', load_polymorphic)
+        timed('load zones, Domain.records', load_relationship)
+    finally:
+        bench_engine.dispose()
+        os.remove(path)
+
+
 @manager.command
 def initdb():
     Base.metadata.create_all(engine)
@@ -27,4 +235,5 @@ def dropdb():
     Base.metadata.drop_all(engine)
 
 if __name__ == '__main__':
+    logging.basicConfig()
     manager.run()